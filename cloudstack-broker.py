@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Ansible,
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+######################################################################
+
+"""
+Ansible CloudStack API broker.
+==============================
+
+Local broker the CloudStack modules of parallel Ansible forks send their API
+calls to, instead of each opening its own connections to the API:
+
+  cloudstack-broker.py --socket ~/.ansible/cloudstack-broker.sock &
+  export CLOUDSTACK_BROKER=~/.ansible/cloudstack-broker.sock
+
+The broker keeps a pool of connections per endpoint and API key. Identical
+list calls in flight at the same time are sent upstream once and every caller
+gets the result, results are then served from a cache for --cache-ttl
+seconds. Queries like queryAsyncJobResult and the lists of async jobs and
+events are forwarded as they are. All other calls are forwarded and clear
+the cache of their endpoint and API key.
+
+Modules not reaching the broker talk to the API directly.
+
+The protocol is a JSON object per line, a request
+{"config": {...}, "command": "listZones", "args": {...}} is answered with
+{"result": {...}} or {"error": "..."}. The command "brokerStats" returns the
+counters of the broker.
+
+
+usage: cloudstack-broker.py [--socket SOCKET] [--cache-ttl CACHE_TTL]
+                            [--pool-size POOL_SIZE] [--verbose]
+"""
+
+import os
+import sys
+import time
+import errno
+import socket
+import signal
+import hashlib
+import argparse
+import threading
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+try:
+    from cs import CloudStack, CloudStackException
+except ImportError:
+    sys.stderr.write("Error: CloudStack library must be installed: pip install cs.\n")
+    sys.exit(1)
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    has_lib_requests = True
+except ImportError:
+    has_lib_requests = False
+
+
+DEFAULT_SOCKET = '~/.ansible/cloudstack-broker.sock'
+
+# Lists of states changing without a write through the broker, never cached
+UNCACHED_LISTS = ['listAsyncJobs', 'listEvents']
+
+
+if has_lib_requests:
+    class BrokerSession(requests.Session):
+        """Session keeping its pooled connections alive."""
+
+        def __exit__(self, *args):
+            # The client uses the session as context manager for every request,
+            # which would close the connections.
+            pass
+
+
+class InFlightCall(object):
+    """Upstream call the callers of the same read wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class CloudStackBroker(object):
+
+    def __init__(self, cache_ttl=5, pool_size=10, verbose=False):
+        self.cache_ttl = cache_ttl
+        self.pool_size = pool_size
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.generations = {}
+        self.in_flight = {}
+        self.cache = {}
+        self.stats = {
+            'requests': 0,
+            'upstream': 0,
+            'coalesced': 0,
+            'cached': 0,
+            'errors': 0,
+        }
+
+
+    def log(self, msg):
+        if self.verbose:
+            sys.stderr.write("%s %s\n" % (time.strftime('%H:%M:%S'), msg))
+
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+
+    def get_client(self, config):
+        """Return the client of an endpoint and API key, created on first use."""
+        client_key = hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+        with self.lock:
+            if client_key not in self.clients:
+                cs = None
+                if has_lib_requests:
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session = BrokerSession()
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    try:
+                        cs = CloudStack(session=session, **config)
+                    except TypeError:
+                        # cs < 2.7.1 does not take a session and connects per request
+                        pass
+                if cs is None:
+                    cs = CloudStack(**config)
+                self.clients[client_key] = cs
+                self.generations[client_key] = 0
+        return client_key, self.clients[client_key]
+
+
+    def call(self, config, command, args):
+        self.count('requests')
+        if command == 'brokerStats':
+            with self.lock:
+                return dict(self.stats, clients=len(self.clients), cache_size=len(self.cache))
+
+        client_key, cs = self.get_client(config)
+        if command.startswith('query') or command in UNCACHED_LISTS:
+            return self.forward(cs, command, args)
+        if not command.startswith('list'):
+            return self.write(client_key, cs, command, args)
+        return self.read(client_key, cs, command, args)
+
+
+    def forward(self, cs, command, args):
+        self.log("forward %s" % command)
+        self.count('upstream')
+        return getattr(cs, command)(**args)
+
+
+    def write(self, client_key, cs, command, args):
+        try:
+            return self.forward(cs, command, args)
+        finally:
+            # Reads may be outdated now, reads in flight are not cached
+            with self.lock:
+                self.generations[client_key] += 1
+                for key in [key for key in self.cache if key[0] == client_key]:
+                    del self.cache[key]
+
+
+    def read(self, client_key, cs, command, args):
+        key = (client_key, command, json.dumps(args, sort_keys=True))
+        now = time.time()
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] > now:
+                self.stats['cached'] += 1
+                return cached[1]
+
+            in_flight = self.in_flight.get(key)
+            owner = in_flight is None
+            if owner:
+                in_flight = InFlightCall()
+                self.in_flight[key] = in_flight
+                generation = self.generations[client_key]
+            else:
+                self.stats['coalesced'] += 1
+
+        if not owner:
+            self.log("coalesce %s" % command)
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.result
+
+        self.log("read %s" % command)
+        try:
+            self.count('upstream')
+            in_flight.result = getattr(cs, command)(**args)
+        except Exception as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+                if in_flight.error is None and self.cache_ttl > 0 and generation == self.generations[client_key]:
+                    self.cache[key] = (time.time() + self.cache_ttl, in_flight.result)
+                self.prune_cache()
+            in_flight.done.set()
+        return in_flight.result
+
+
+    def prune_cache(self):
+        now = time.time()
+        for key in [key for key, value in self.cache.items() if value[0] <= now]:
+            del self.cache[key]
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        broker = self.server.broker
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                request = json.loads(line.decode('utf-8'))
+                response = {'result': broker.call(request.get('config') or {}, request['command'], request.get('args') or {})}
+            except (CloudStackException, ValueError, KeyError, TypeError) as e:
+                broker.count('errors')
+                response = {'error': str(e)}
+            except Exception as e:
+                broker.count('errors')
+                response = {'error': "%s: %s" % (e.__class__.__name__, e)}
+            try:
+                self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+                self.wfile.flush()
+            except socket.error:
+                return
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local broker of CloudStack API calls.')
+    parser.add_argument('--socket', default=os.environ.get('CLOUDSTACK_BROKER', DEFAULT_SOCKET),
+                        help='path of the Unix socket, default $CLOUDSTACK_BROKER or %s' % DEFAULT_SOCKET)
+    parser.add_argument('--cache-ttl', type=float, default=5,
+                        help='seconds list results are served from the cache, 0 to disable')
+    parser.add_argument('--pool-size', type=int, default=10,
+                        help='max connections per endpoint and API key')
+    parser.add_argument('--verbose', action='store_true')
+    options = parser.parse_args()
+
+    socket_path = os.path.expanduser(options.socket)
+    socket_dir = os.path.dirname(socket_path)
+    if socket_dir and not os.path.isdir(socket_dir):
+        os.makedirs(socket_dir)
+    try:
+        os.remove(socket_path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    # The socket forwards calls with the API keys of its users only
+    os.umask(0o077)
+    server = BrokerServer(socket_path, BrokerHandler)
+    server.broker = CloudStackBroker(cache_ttl=options.cache_ttl, pool_size=options.pool_size, verbose=options.verbose)
+    # Remove the socket on kill as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    sys.stderr.write("CloudStack API broker listening on %s\n" % socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+if __name__ == '__main__':
+    main()
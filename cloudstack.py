@@ -31,6 +31,17 @@ script, e.g. project_cloudstack.sh:
   #!/bin/bash
   cloudstack.py --project <your_project> $@
 
+Several projects and regions (sections of 'cloudstack.ini') are listed
+concurrently and merged, the hosts are added to the groups 'project_<project>'
+and 'region_<region>', other characters than letters, digits and underscores
+replaced by underscores. Pass them several times or comma separated, or set
+them in the [inventory] section:
+
+  [inventory]
+  projects = web, db
+  regions = cloudstack, exoscale
+  workers = 4
+
 
 When run against a specific host, this script returns the following attributes
 based on the data obtained from CloudStack API:
@@ -67,12 +78,82 @@ based on the data obtained from CloudStack API:
   }
 
 
-usage: cloudstack.py [--list] [--host HOST] [--project PROJECT]
+The output of --list is cached for 'cache_max_age' seconds in 'cache_path',
+both configured in the [inventory] section of 'cloudstack.ini':
+
+  [inventory]
+  cache_path = ~/.ansible/tmp
+  cache_max_age = 300
+  page_size = 500
+  stream = false
+
+Use --refresh-cache to ignore the cache, a 'cache_max_age' of 0 disables it.
+Along with the cache an index of the hostvars by host name is written, --host
+is answered from it and falls back to an API call filtered by the host name.
+
+With 'incremental' set, an expired cache is patched instead of refetched: the
+VMs of events and async jobs since the newest one seen by the last sync (less
+'incremental_margin' seconds) are fetched by id. The times are those of the
+server. A full refresh happens 'incremental_max_age' seconds after the last
+one or with --refresh-cache.
+
+  [inventory]
+  incremental = true
+  incremental_max_age = 3600
+  incremental_margin = 60
+
+The hostvars emitted are limited with 'hostvars' (or --hostvars), 'meta = false'
+(or --no-meta) emits none at all and 'compact' (or --compact) writes compact
+JSON:
+
+  [inventory]
+  hostvars = zone, state, default_ip
+  meta = true
+  compact = false
+
+Besides their instance group, the hosts are grouped by the keys in
+'keyed_groups' (or --keyed-groups), e.g. 'zone_ZUERICH', 'state_Running' or
+'tags_<key>_<value>'. Characters not valid in variable names are replaced by
+'_':
+
+  [inventory]
+  keyed_groups = zone, service_offering, hypervisor, tags, affinity_group, security_group, state
+
+Besides VMs, 'sources' (or --sources) adds virtual routers and system VMs, all
+fetched concurrently. The hosts are then also grouped by kind in 'vms',
+'routers' and 'system_vms'. Routers are grouped by domain, zone, project,
+account and redundant state, with 'non_running_routers' (or --non-running)
+routers not running are added to the group 'non_running_routers' only.
+cloudstack-routers.py runs this script with --sources routers. System VMs are grouped by their type and
+listed once per region. Only VMs are patched by 'incremental'.
+
+  [inventory]
+  sources = vms, routers, system_vms
+  non_running_routers = false
+
+The hosts are fetched 'page_size' at a time. With --stream (or 'stream'), the
+output is compact JSON written while the pages arrive, the memory used then
+depends on the page size rather than on the number of hosts.
+
+
+usage: cloudstack.py [--list] [--host HOST] [--project PROJECT] [--region REGION]
+                     [--refresh-cache] [--stream] [--hostvars HOSTVARS]
+                     [--no-meta] [--compact] [--keyed-groups KEYED_GROUPS]
+                     [--sources SOURCES] [--non-running]
 """
 
 import os
+import re
 import sys
+import time
+import hashlib
+import shutil
+import datetime
 import argparse
+import tempfile
+import threading
+import ConfigParser
+from multiprocessing.pool import ThreadPool
 
 try:
     import json
@@ -87,13 +168,96 @@ except ImportError:
     sys.exit(1)
 
 
+# Keyed groups: group name prefix and the values of a host to group by
+KEYED_GROUPS = {
+    'zone':             lambda host: [host.get('zonename')],
+    'service_offering': lambda host: [host.get('serviceofferingname')],
+    'hypervisor':       lambda host: [host.get('hypervisor')],
+    'state':            lambda host: [host.get('state')],
+    'tags':             lambda host: ["%s_%s" % (tag['key'], tag['value']) for tag in host.get('tags', [])],
+    'affinity_group':   lambda host: [group['name'] for group in host.get('affinitygroup', [])],
+    'security_group':   lambda host: [group['name'] for group in host.get('securitygroup', [])],
+}
+
+
+# Kinds of hosts in the inventory
+SOURCES = ['vms', 'routers', 'system_vms']
+
+
+class InventoryError(Exception):
+    pass
+
+
+class InventoryStream(object):
+    """Write the inventory as compact JSON while the hosts are fetched.
+
+    The hostvars are written as they arrive, the groups only hold host names
+    and follow once all hosts are known. With an index file, the hostvars
+    are written to it as well.
+    """
+    def __init__(self, outs, index=None):
+        self.outs = outs
+        self.index = index
+        self.empty = True
+        # Hosts of several projects and regions are added concurrently
+        self.lock = threading.Lock()
+        self.write('{"_meta": {"hostvars": {')
+        if self.index:
+            self.index.write('{')
+
+
+    def write(self, value):
+        for out in self.outs:
+            out.write(value)
+
+
+    def add_host(self, host_name, hostvars):
+        entry = '%s: %s' % (json.dumps(host_name), json.dumps(hostvars, separators=(',', ':')))
+        with self.lock:
+            if not self.empty:
+                entry = ', ' + entry
+            self.empty = False
+            self.write(entry)
+            if self.index:
+                self.index.write(entry)
+
+
+    def close(self, data):
+        self.write('}}')
+        for group_name, group in data.iteritems():
+            if group_name != '_meta':
+                self.write(', %s: %s' % (json.dumps(group_name), json.dumps(group, separators=(',', ':'))))
+        self.write('}')
+        if self.index:
+            self.index.write('}')
+
+
 class CloudStackInventory(object):
     def __init__(self):
 
         parser = argparse.ArgumentParser()
         parser.add_argument('--host')
         parser.add_argument('--list', action='store_true')
-        parser.add_argument('--project')
+        parser.add_argument('--project', action='append',
+                            help='project to list, may be given several times or comma separated')
+        parser.add_argument('--region', action='append',
+                            help='region (ini section) to list, may be given several times or comma separated')
+        parser.add_argument('--refresh-cache', action='store_true',
+                            help='ignore the cache and fetch the inventory from the API')
+        parser.add_argument('--stream', action='store_true',
+                            help='write compact JSON while the hosts are fetched')
+        parser.add_argument('--hostvars',
+                            help='comma separated hostvars to emit, default all')
+        parser.add_argument('--no-meta', action='store_true',
+                            help='emit no hostvars in --list')
+        parser.add_argument('--compact', action='store_true',
+                            help='write compact JSON')
+        parser.add_argument('--keyed-groups',
+                            help='comma separated keys to group the hosts by: %s' % ', '.join(sorted(KEYED_GROUPS)))
+        parser.add_argument('--sources',
+                            help='comma separated kinds of hosts to list: %s' % ', '.join(SOURCES))
+        parser.add_argument('--non-running', action='store_true',
+                            help='add routers not running to the group non_running_routers')
 
         options = parser.parse_args()
         try:
@@ -101,73 +265,700 @@ class CloudStackInventory(object):
         except CloudStackException, e:
             print >> sys.stderr, "Error: Could not connect to CloudStack API"
 
+        self.read_settings()
+        if options.hostvars:
+            self.hostvars = self.split_list([options.hostvars])
+        if options.no_meta:
+            self.meta = False
+        if options.compact:
+            self.compact = True
+        if options.keyed_groups:
+            self.keyed_groups = self.split_list([options.keyed_groups])
+        if options.sources:
+            self.sources = self.split_list([options.sources])
+        if options.non_running:
+            self.non_running = True
+        targets = self.targets = self.get_targets(options.region, options.project)
+
+        try:
+            for key in self.keyed_groups:
+                if key not in KEYED_GROUPS:
+                    raise InventoryError("Unknown keyed group %s, use one of: %s" % (key, ', '.join(sorted(KEYED_GROUPS))))
+            for source in self.sources:
+                if source not in SOURCES:
+                    raise InventoryError("Unknown source %s, use one of: %s" % (source, ', '.join(SOURCES)))
+
+            if options.host:
+                data = self.get_host(options.host, targets)
+                print self.dumps(data)
+
+            elif options.list and (options.stream or self.stream):
+                self.stream_cached_list(sys.stdout, targets, options.refresh_cache)
+                print
+
+            elif options.list:
+                data = self.get_cached_list(targets, options.refresh_cache)
+                print self.dumps(data)
+            else:
+                print >> sys.stderr, "usage: --list | --host <hostname> [--project <project>] [--region <region>] [--refresh-cache] [--stream] [--hostvars <hostvars>] [--no-meta] [--compact]"
+                sys.exit(1)
+        except InventoryError, e:
+            print >> sys.stderr, "Error: %s" % e
+            sys.exit(1)
+
+
+    def read_settings(self):
+        """Read the inventory settings from the [inventory] section of cloudstack.ini."""
+        config = ConfigParser.SafeConfigParser()
+        config_files = [
+            os.path.expanduser('~/.cloudstack.ini'),
+            os.path.join(os.getcwd(), 'cloudstack.ini'),
+        ]
+        if 'CLOUDSTACK_CONFIG' in os.environ:
+            config_files.append(os.path.expanduser(os.environ['CLOUDSTACK_CONFIG']))
+        config.read(config_files)
+
+        self.cache_path = os.path.expanduser('~/.ansible/tmp')
+        self.cache_max_age = 0
+        self.page_size = 500
+        self.stream = False
+        self.projects = []
+        self.regions = []
+        self.workers = 4
+        self.incremental = False
+        self.incremental_max_age = 3600
+        self.incremental_margin = 60
+        self.hostvars = []
+        self.meta = True
+        self.compact = False
+        self.keyed_groups = []
+        self.sources = ['vms']
+        self.non_running = False
+        if config.has_section('inventory'):
+            if config.has_option('inventory', 'cache_path'):
+                self.cache_path = os.path.expanduser(config.get('inventory', 'cache_path'))
+            if config.has_option('inventory', 'cache_max_age'):
+                self.cache_max_age = config.getint('inventory', 'cache_max_age')
+            if config.has_option('inventory', 'page_size'):
+                self.page_size = config.getint('inventory', 'page_size')
+            if config.has_option('inventory', 'stream'):
+                self.stream = config.getboolean('inventory', 'stream')
+            if config.has_option('inventory', 'projects'):
+                self.projects = self.split_list([config.get('inventory', 'projects')])
+            if config.has_option('inventory', 'regions'):
+                self.regions = self.split_list([config.get('inventory', 'regions')])
+            if config.has_option('inventory', 'workers'):
+                self.workers = config.getint('inventory', 'workers')
+            if config.has_option('inventory', 'incremental'):
+                self.incremental = config.getboolean('inventory', 'incremental')
+            if config.has_option('inventory', 'incremental_max_age'):
+                self.incremental_max_age = config.getint('inventory', 'incremental_max_age')
+            if config.has_option('inventory', 'incremental_margin'):
+                self.incremental_margin = config.getint('inventory', 'incremental_margin')
+            if config.has_option('inventory', 'hostvars'):
+                self.hostvars = self.split_list([config.get('inventory', 'hostvars')])
+            if config.has_option('inventory', 'meta'):
+                self.meta = config.getboolean('inventory', 'meta')
+            if config.has_option('inventory', 'compact'):
+                self.compact = config.getboolean('inventory', 'compact')
+            if config.has_option('inventory', 'keyed_groups'):
+                self.keyed_groups = self.split_list([config.get('inventory', 'keyed_groups')])
+            if config.has_option('inventory', 'sources'):
+                self.sources = self.split_list([config.get('inventory', 'sources')])
+            if config.has_option('inventory', 'non_running_routers'):
+                self.non_running = config.getboolean('inventory', 'non_running_routers')
+
+
+    def dumps(self, data):
+        if self.compact:
+            return json.dumps(data, separators=(',', ':'))
+        return json.dumps(data, indent=2)
+
+
+    def filter_hostvars(self, hostvars):
+        if not self.hostvars:
+            return hostvars
+        return dict((key, value) for key, value in hostvars.iteritems() if key in self.hostvars)
+
+
+    def split_list(self, values):
+        return [v.strip() for value in values or [] for v in value.split(',') if v.strip()]
+
+
+    def get_targets(self, regions=None, projects=None):
+        """Return the (region, project) pairs to list, None stands for the default."""
+        regions = self.split_list(regions) or self.regions or [None]
+        projects = self.split_list(projects) or self.projects or [None]
+        return [(region, project) for region in regions for project in projects]
+
+
+    def get_client(self, region=None):
+        # A client per target, they are used by several threads at once
+        if region:
+            return CloudStack(**read_config(region))
+        return CloudStack(**read_config())
+
+
+    def map_targets(self, func, targets):
+        """Call func for every target concurrently, the results keep the order of the targets."""
+        if len(targets) == 1:
+            return [func(targets[0])]
+        pool = ThreadPool(min(self.workers, len(targets)))
+        try:
+            return pool.map(func, targets)
+        finally:
+            pool.close()
+
+
+    def get_cache_file(self, targets, suffix='cache'):
+        # Scope the cache by regions and projects, several clouds may share the cache path
+        if targets == [(None, None)]:
+            scope = "%s|" % self.cs.endpoint
+        else:
+            scope = ','.join("%s|%s" % (region or '', project or '') for region, project in targets)
+            scope = "%s|%s" % (self.cs.endpoint, scope)
+        # The cached output depends on the hosts and hostvars emitted and the groups
+        if self.hostvars or not self.meta or self.keyed_groups or self.sources != ['vms'] or self.non_running:
+            scope = "%s|%s|%s|%s|%s|%s" % (scope, ','.join(sorted(self.hostvars)), self.meta, ','.join(sorted(self.keyed_groups)),
+                                           ','.join(sorted(self.sources)), self.non_running)
+        return os.path.join(self.cache_path, 'ansible-cloudstack-%s.%s' % (hashlib.sha1(scope).hexdigest()[:12], suffix))
+
+
+    def is_cache_valid(self, cache_file, max_age=None):
+        if self.cache_max_age <= 0 or not os.path.isfile(cache_file):
+            return False
+        if max_age is None:
+            max_age = self.cache_max_age
+        return os.path.getmtime(cache_file) + max_age >= time.time()
+
+
+    def read_cache(self, cache_file, max_age=None):
+        if not self.is_cache_valid(cache_file, max_age):
+            return None
+        try:
+            with open(cache_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+
+    def open_cache(self, cache_file):
+        """Return a temp file replacing the cache file on close_cache()."""
+        if self.cache_max_age <= 0:
+            return None
+        try:
+            if not os.path.isdir(self.cache_path):
+                os.makedirs(self.cache_path)
+            # Write to a temp file and rename it, readers never see a partial file
+            fd, tmp_file = tempfile.mkstemp(dir=self.cache_path, prefix='.ansible-cloudstack-')
+            return (os.fdopen(fd, 'w'), tmp_file, cache_file)
+        except (IOError, OSError), e:
+            print >> sys.stderr, "Warning: Could not write cache file %s: %s" % (cache_file, e)
+        return None
+
+
+    def close_cache(self, cache, commit=True):
+        if not cache:
+            return
+        f, tmp_file, cache_file = cache
+        try:
+            f.close()
+            if commit:
+                os.rename(tmp_file, cache_file)
+            else:
+                os.remove(tmp_file)
+        except (IOError, OSError), e:
+            print >> sys.stderr, "Warning: Could not write cache file %s: %s" % (cache_file, e)
+
+
+    def write_cache(self, cache_file, data):
+        cache = self.open_cache(cache_file)
+        if cache:
+            json.dump(data, cache[0])
+            self.close_cache(cache)
+
+
+    def get_cached_list(self, targets, refresh=False):
+        cache_file = self.get_cache_file(targets)
+        if not refresh:
+            data = self.read_cache(cache_file)
+            if data is not None:
+                return data
+            if self.incremental:
+                data = self.sync_list(targets)
+                if data is not None:
+                    return data
+
+        synced = time.time()
+        marks = self.get_sync_marks(targets)
+        results = self.map_targets(self.get_target_list, targets)
+        data = self.merge_lists([target_data for target_data, host_ids in results])
+        self.write_cache(cache_file, data)
+        # Index of the hostvars by host name answering --host
+        self.write_cache(self.get_cache_file(targets, 'index'), data['_meta']['hostvars'])
+        self.write_sync_state(targets, synced, marks, [host_ids for target_data, host_ids in results])
+        return data
+
+
+    def stream_cached_list(self, out, targets, refresh=False):
+        cache_file = self.get_cache_file(targets)
+        if not refresh and self.is_cache_valid(cache_file):
+            with open(cache_file) as f:
+                shutil.copyfileobj(f, out)
+            return
+
+        if not refresh and self.incremental:
+            data = self.sync_list(targets)
+            if data is not None:
+                json.dump(data, out, separators=(',', ':'))
+                return
+
+        synced = time.time()
+        marks = self.get_sync_marks(targets)
+        cache = self.open_cache(cache_file)
+        index = self.open_cache(self.get_cache_file(targets, 'index'))
+        outs = [out]
+        if cache:
+            outs.append(cache[0])
+        stream = InventoryStream(outs, index and index[0])
+        try:
+            results = self.map_targets(lambda target: self.get_target_list(target, stream), targets)
+            data = self.merge_lists([target_data for target_data, host_ids in results])
+            stream.close(data)
+        except:
+            self.close_cache(cache, commit=False)
+            self.close_cache(index, commit=False)
+            raise
+        self.close_cache(cache)
+        self.close_cache(index)
+        self.write_sync_state(targets, synced, marks, [host_ids for target_data, host_ids in results])
+
+
+    def get_sync_marks(self, targets):
+        """Return the time of the newest event of every target, in the time of the server."""
+        if not self.incremental or self.sources != ['vms']:
+            return None
+        return self.map_targets(self.get_target_mark, targets)
+
+
+    def get_target_mark(self, target):
+        region, project = target
+        cs = self.get_client(region)
         project_id = ''
-        if options.project:
-            project_id = self.get_project_id(options.project)
+        if project:
+            project_id = self.get_project_id(project, cs)
+        # Events are listed newest first
+        events = cs.listEvents(projectid=project_id, listall=True, page=1, pagesize=1)
+        if events and events.get('event'):
+            return events['event'][0]['created']
+        return None
+
+
+    def write_sync_state(self, targets, synced, marks, target_host_ids):
+        """Store the time of the full fetch, the marks the next sync lists changes
+        from and the host name and groups of every host by id."""
+        if marks is None:
+            return
+        hosts = {}
+        for i, host_ids in enumerate(target_host_ids):
+            for host_id, (host_name, group_names) in host_ids.iteritems():
+                hosts[host_id] = [host_name, group_names, i]
+        self.write_cache(self.get_cache_file(targets, 'sync'), {
+            'synced': synced,
+            'marks': marks,
+            'hosts': hosts,
+        })
+
+
+    def sync_list(self, targets):
+        """Patch the cached inventory with the hosts changed since the last sync.
+
+        Return None if there is nothing to patch, a full refresh is needed then.
+        """
+        # Routers and system VMs are not tracked by the sync
+        if self.sources != ['vms']:
+            return None
+
+        sync_file = self.get_cache_file(targets, 'sync')
+        state = self.read_cache(sync_file, self.incremental_max_age)
+        data = self.read_cache(self.get_cache_file(targets), self.incremental_max_age)
+        if state is None or data is None or 'marks' not in state:
+            return None
+        # The files are rewritten by every sync, the time of the full fetch counts
+        if state['synced'] + self.incremental_max_age < time.time():
+            return None
+        # Without an event there is no time of the server to list changes from
+        if None in state['marks']:
+            return None
+
+        target_since = zip(targets, [self.get_since(mark) for mark in state['marks']])
+        results = self.map_targets(lambda args: self.get_target_changes(*args), target_since)
+
+        hosts = state['hosts']
+        marks = []
+        for i, (changed_ids, changed_hosts, mark) in enumerate(results):
+            marks.append(max(mark, state['marks'][i], key=self.get_sortable_time))
+            for host_id in changed_ids:
+                if host_id in hosts and hosts[host_id][2] == i:
+                    self.remove_host(data, hosts, host_id)
+            for host in changed_hosts:
+                host_name, group_names = self.add_host(data, host, extra_groups=self.get_target_groups(targets[i]))
+                hosts[host['id']] = [host_name, group_names, i]
+
+        self.write_cache(self.get_cache_file(targets), data)
+        self.write_cache(self.get_cache_file(targets, 'index'), data['_meta']['hostvars'])
+        self.write_cache(sync_file, {
+            'synced': state['synced'],
+            'marks': marks,
+            'hosts': hosts,
+        })
+        return data
+
+
+    def get_sortable_time(self, created):
+        # e.g. 2016-10-16T10:26:05+0200 -> 2016-10-16 10:26:05, all of a server share the time zone
+        return (created or '')[:19].replace('T', ' ')
 
-        if options.host:
-            data = self.get_host(options.host)
-            print json.dumps(data, indent=2)
 
-        elif options.list:
-            data = self.get_list()
-            print json.dumps(data, indent=2)
+    def get_since(self, mark):
+        """Return the start dates of the events and of the jobs after a mark, less
+        the margin for events logged while the last sync was running."""
+        since = datetime.datetime.strptime(self.get_sortable_time(mark), '%Y-%m-%d %H:%M:%S')
+        since -= datetime.timedelta(seconds=self.incremental_margin)
+        # listEvents takes the time of the server, listAsyncJobs an ISO 8601
+        # date with the offset, e.g. 2016-10-16T10:26:05+0200
+        return since.strftime('%Y-%m-%d %H:%M:%S'), since.strftime('%Y-%m-%dT%H:%M:%S') + (mark[19:] or '+0000')
+
+
+    def get_target_changes(self, target, since):
+        """Return the ids of the hosts changed since then, the hosts still existing
+        and the time of the newest event or job."""
+        events_since, jobs_since = since
+        region, project = target
+        cs = self.get_client(region)
+        project_id = ''
+        if project:
+            project_id = self.get_project_id(project, cs)
+
+        changed_ids = set()
+        mark = None
+        for event in self.iter_pages(cs.listEvents, 'event', projectid=project_id, startdate=events_since, listall=True):
+            mark = max(mark, event['created'], key=self.get_sortable_time)
+            if event.get('resourcetype') == 'VirtualMachine' and event.get('resourceid') and event['type'].split('.')[0] in ['VM', 'NIC']:
+                changed_ids.add(event['resourceid'])
+        for job in self.iter_pages(cs.listAsyncJobs, 'asyncjobs', startdate=jobs_since, listall=True):
+            mark = max(mark, job['created'], key=self.get_sortable_time)
+            if job.get('jobinstancetype') == 'VirtualMachine' and job.get('jobinstanceid'):
+                changed_ids.add(job['jobinstanceid'])
+
+        changed_ids = sorted(changed_ids)
+        changed_hosts = []
+        # Keep the URLs short, 50 ids are about 2k characters
+        for i in range(0, len(changed_ids), 50):
+            ids = ','.join(changed_ids[i:i + 50])
+            changed_hosts.extend(self.iter_pages(cs.listVirtualMachines, 'virtualmachine', projectid=project_id, ids=ids))
+        return changed_ids, changed_hosts, mark
+
+
+    def remove_host(self, data, hosts, host_id):
+        host_name, group_names, target = hosts.pop(host_id)
+        for group_name in group_names:
+            if group_name in data and host_name in data[group_name]['hosts']:
+                data[group_name]['hosts'].remove(host_name)
+        # Keep the hostvars if another host has the same name
+        if not [h for h in hosts.itervalues() if h[0] == host_name]:
+            data['_meta']['hostvars'].pop(host_name, None)
+
+
+    def get_target_list(self, target, stream=None):
+        region, project = target
+        cs = self.get_client(region)
+        project_id = ''
+        if project:
+            project_id = self.get_project_id(project, cs)
+        target_groups = self.get_target_groups(target)
+
+        # Routers and system VMs are fetched in the background while the VMs are listed
+        fetches = self.get_target_fetches(target, project_id)
+        if fetches:
+            pool = ThreadPool(len(fetches))
+            results = [(source, pool.apply_async(self.fetch, (region, source, args))) for source, args in fetches]
+
+        host_ids = {}
+        if 'vms' in self.sources:
+            data = self.get_list(project_id, stream, cs, target_groups, host_ids)
         else:
-            print >> sys.stderr, "usage: --list | --host <hostname> [--project <project>]"
-            sys.exit(1)
+            data = self.new_list()
+
+        if fetches:
+            try:
+                router_ids = set()
+                for source, result in results:
+                    for item in result.get():
+                        if source == 'system_vms':
+                            self.add_system_vm(data, item, stream, target_groups)
+                        elif item['id'] not in router_ids:
+                            # The routers of projects and accounts may overlap
+                            router_ids.add(item['id'])
+                            self.add_router(data, item, stream, target_groups)
+            finally:
+                pool.close()
+        return data, host_ids
+
+
+    def get_target_fetches(self, target, project_id=''):
+        """Return the sources and API args of the routers and system VMs of a target."""
+        region, project = target
+        fetches = []
+        if 'routers' in self.sources:
+            if project_id:
+                fetches.append(('routers', dict(projectid=project_id)))
+            else:
+                fetches.append(('routers', dict(projectid=-1)))
+                fetches.append(('routers', dict()))
+        # System VMs belong to no project, list them once per region
+        if 'system_vms' in self.sources and target == [t for t in self.targets if t[0] == region][0]:
+            fetches.append(('system_vms', dict()))
+        return fetches
+
+
+    def fetch(self, region, source, args):
+        # A client per thread
+        cs = self.get_client(region)
+        if source == 'routers':
+            return list(self.iter_pages(cs.listRouters, 'router', listall=True, **args))
+        return list(self.iter_pages(cs.listSystemVms, 'systemvm', **args))
+
+
+    def get_target_groups(self, target):
+        # Make a group per region and project
+        region, project = target
+        return [self.get_group_name(group_name) for group_name in [region and 'region_%s' % region, project and 'project_%s' % project] if group_name]
+
+
+    def merge_lists(self, lists):
+        """Merge the lists of several targets, later hostvars of a host name win."""
+        data = lists[0]
+        for target_data in lists[1:]:
+            for group_name, group in target_data.iteritems():
+                if group_name == '_meta':
+                    data['_meta']['hostvars'].update(group['hostvars'])
+                elif group_name in data:
+                    data[group_name]['hosts'].extend(group['hosts'])
+                else:
+                    data[group_name] = group
+        return data
 
 
-    def get_project_id(self, project):
-        projects = self.cs.listProjects()
+    def get_project_id(self, project, cs=None):
+        projects = (cs or self.cs).listProjects(listall=True)
         if projects:
             for p in projects['project']:
                 if p['name'] == project or p['id'] == project:
                     return p['id']
-        print >> sys.stderr, "Error: Project %s not found." % project
-        sys.exit(1)
+        raise InventoryError("Project %s not found." % project)
+
+
+    def get_hostvars(self, host):
+        hostvars = {}
+        hostvars['zone'] = host['zonename']
+        if 'group' in host:
+            hostvars['group'] = host['group']
+        hostvars['state'] = host['state']
+        hostvars['service_offering'] = host['serviceofferingname']
+        hostvars['affinity_group'] = host['affinitygroup']
+        hostvars['security_group'] = host['securitygroup']
+        hostvars['cpu_number'] = host['cpunumber']
+        hostvars['cpu_speed'] = host['cpuspeed']
+        if 'cpuused' in host:
+            hostvars['cpu_used'] = host['cpuused']
+        hostvars['memory'] = host['memory']
+        hostvars['tags'] = host['tags']
+        hostvars['hypervisor'] = host['hypervisor']
+        hostvars['created'] = host['created']
+        hostvars['nic'] = []
+        for nic in host['nic']:
+            hostvars['nic'].append({
+                'ip': nic['ipaddress'],
+                'mac': nic['macaddress'],
+                'netmask': nic['netmask'],
+                'gateway': nic['gateway'],
+                'type': nic['type'],
+                })
+            if nic['isdefault']:
+                hostvars['default_ip'] = nic['ipaddress']
+        return self.filter_hostvars(hostvars)
+
+
+    def get_host(self, name, targets):
+        index = self.read_cache(self.get_cache_file(targets, 'index'))
+        if index is not None and name in index:
+            return index[name]
+
+        data = {}
+        for target_data in self.map_targets(lambda target: self.get_target_host(name, target), targets):
+            # The last host of a name wins, same as in --list
+            if target_data:
+                data = target_data
+        return data
 
 
-    def get_host(self, name, project_id=''):
-        hosts = self.cs.listVirtualMachines(projectid=project_id)
-        if not hosts:
-            return {}
+    def get_target_host(self, name, target):
+        region, project = target
+        cs = self.get_client(region)
+        project_id = ''
+        if project:
+            project_id = self.get_project_id(project, cs)
 
         data = {}
-        for host in hosts['virtualmachine']:
-            host_name = host['displayname']
-            if name == host_name:
-                data['zone'] = host['zonename']
-                if 'group' in host:
-                    data['group'] = host['group']
-                data['state'] = host['state']
-                data['service_offering'] = host['serviceofferingname']
-                data['affinity_group'] = host['affinitygroup']
-                data['security_group'] = host['securitygroup']
-                data['cpu_number'] = host['cpunumber']
-                data['cpu_speed'] = host['cpuspeed']
-                if 'cpuused' in host:
-                    data['cpu_used'] = host['cpuused']
-                data['memory'] = host['memory']
-                data['tags'] = host['tags']
-                data['hypervisor'] = host['hypervisor']
-                data['created'] = host['created']
-                data['nic'] = []
-                for nic in host['nic']:
-                    data['nic'].append({
-                        'ip': nic['ipaddress'],
-                        'mac': nic['macaddress'],
-                        'netmask': nic['netmask'],
-                        'gateway': nic['gateway'],
-                        'type': nic['type'],
-                    })
-                    if nic['isdefault']:
-                        data['default_ip'] = nic['ipaddress']
-                break;
+        if 'vms' in self.sources:
+            # The keyword filters by display name on the server side
+            for host in self.iter_pages(cs.listVirtualMachines, 'virtualmachine', projectid=project_id, keyword=name):
+                if name == host['displayname']:
+                    data = self.get_hostvars(host)
+
+        for source, args in self.get_target_fetches(target, project_id):
+            for item in self.fetch(region, source, dict(args, name=name)):
+                if name != item['name']:
+                    continue
+                if source == 'routers':
+                    data = self.get_router_hostvars(item)
+                else:
+                    data = self.get_system_vm_hostvars(item)
         return data
 
 
-    def get_list(self, project_id=''):
-        data = {
+    def iter_pages(self, list_method, key, **kwargs):
+        """Yield the items of a list API call page by page."""
+        page = 1
+        while True:
+            result = list_method(page=page, pagesize=self.page_size, **kwargs)
+            if not result or key not in result:
+                return
+            for item in result[key]:
+                yield item
+            if len(result[key]) < self.page_size or page * self.page_size >= result.get('count', 0):
+                return
+            page += 1
+
+
+    def get_hosts(self, project_id='', cs=None):
+        return self.iter_pages((cs or self.cs).listVirtualMachines, 'virtualmachine', projectid=project_id)
+
+
+    def add_host(self, data, host, stream=None, extra_groups=None):
+        """Add a VM to the inventory, return its name and the names of its groups."""
+        host_name = host['displayname']
+        group_names = ['all'] + (extra_groups or [])
+        if len(self.sources) > 1:
+            group_names.append('vms')
+        if host.get('group'):
+            group_names.append(host['group'])
+        for key in self.keyed_groups:
+            for value in KEYED_GROUPS[key](host):
+                if value:
+                    group_names.append(self.get_group_name("%s_%s" % (key, value)))
+
+        self.add_inventory_host(data, host_name, group_names, lambda: self.get_hostvars(host), stream)
+        return host_name, group_names
+
+
+    def add_router(self, data, router, stream=None, extra_groups=None):
+        router_name = router['name']
+        if router['state'] != 'Running':
+            if self.non_running:
+                # Routers not running are kept apart from the other groups
+                self.add_inventory_host(data, router_name, ['non_running_routers'], lambda: self.get_router_hostvars(router), stream)
+            return
+
+        # Make a group per domain, zone, project and account
+        group_names = ['all', 'routers'] + (extra_groups or [])
+        group_names += [router[key] for key in ['domain', 'zonename', 'project', 'account'] if key in router]
+        if router.get('redundantstate') in ['MASTER', 'BACKUP']:
+            group_names.append('redundant_routers')
+        if router.get('redundantstate') == 'MASTER':
+            group_names.append('redundant_master_routers')
+        if router.get('redundantstate') == 'BACKUP':
+            group_names.append('redundant_backup_routers')
+        if router.get('redundantstate') == 'UNKNOWN':
+            group_names.append('non_redundant_routers')
+        self.add_inventory_host(data, router_name, group_names, lambda: self.get_router_hostvars(router), stream)
+
+
+    def add_system_vm(self, data, system_vm, stream=None, extra_groups=None):
+        # Make a group per type, e.g. consoleproxy or secondarystoragevm
+        group_names = ['all', 'system_vms', system_vm['systemvmtype']] + (extra_groups or [])
+        self.add_inventory_host(data, system_vm['name'], group_names, lambda: self.get_system_vm_hostvars(system_vm), stream)
+
+
+    def add_inventory_host(self, data, host_name, group_names, get_hostvars, stream=None):
+        for group_name in group_names:
+            if group_name not in data:
+                data[group_name] = {
+                    'hosts': []
+                }
+            data[group_name]['hosts'].append(host_name)
+
+        if self.meta and stream:
+            stream.add_host(host_name, get_hostvars())
+        elif self.meta:
+            data['_meta']['hostvars'][host_name] = get_hostvars()
+
+
+    def get_router_hostvars(self, router):
+        hostvars = {}
+        hostvars['group'] = router['domain']
+        hostvars['domain'] = router['domain']
+        if 'networkdomain' in router:
+            hostvars['networkdomain'] = router['networkdomain']
+        hostvars['zone'] = router['zonename']
+        if 'project' in router:
+            hostvars['project'] = router['project']
+        if 'account' in router:
+            hostvars['account'] = router['account']
+        if 'linklocalip' in router:
+            hostvars['ansible_ssh_host'] = router['linklocalip']
+        hostvars['state'] = router['state']
+        if 'redundantstate' in router:
+            hostvars['redundant_state'] = router['redundantstate']
+        hostvars['service_offering'] = router['serviceofferingname']
+        if 'role' in router:
+            hostvars['role'] = router['role']
+        hostvars['nic'] = []
+        for nic in router['nic']:
+            hostvars['nic'].append({
+                'ip': nic['ipaddress'],
+                'mac': nic['macaddress'],
+                'netmask': nic['netmask'],
+                })
+            if nic['isdefault']:
+                hostvars['default_ip'] = nic['ipaddress']
+        return self.filter_hostvars(hostvars)
+
+
+    def get_system_vm_hostvars(self, system_vm):
+        hostvars = {}
+        hostvars['zone'] = system_vm['zonename']
+        hostvars['state'] = system_vm['state']
+        hostvars['system_vm_type'] = system_vm['systemvmtype']
+        if 'linklocalip' in system_vm:
+            hostvars['ansible_ssh_host'] = system_vm['linklocalip']
+        if 'publicip' in system_vm:
+            hostvars['public_ip'] = system_vm['publicip']
+        if 'privateip' in system_vm:
+            hostvars['private_ip'] = system_vm['privateip']
+        if 'created' in system_vm:
+            hostvars['created'] = system_vm['created']
+        return self.filter_hostvars(hostvars)
+
+
+    def get_group_name(self, name):
+        # Group names are valid variable names
+        return re.sub(r'[^A-Za-z0-9_]', '_', name)
+
+
+    def new_list(self):
+        return {
             'all': {
                 'hosts': [],
                 },
@@ -176,54 +967,15 @@ class CloudStackInventory(object):
                 },
             }
 
-        groups = self.cs.listInstanceGroups(projectid=project_id)
-        if groups:
-            for group in groups['instancegroup']:
-                group_name = group['name']
-                if group_name and not group_name in data:
-                    data[group_name] = {
-                            'hosts': []
-                        }
-
-        hosts = self.cs.listVirtualMachines(projectid=project_id)
-        if hosts:
-            for host in hosts['virtualmachine']:
-                host_name = host['displayname']
-                data['all']['hosts'].append(host_name)
-                data['_meta']['hostvars'][host_name] = {}
-                data['_meta']['hostvars'][host_name]['zone'] = host['zonename']
-                if 'group' in host:
-                    data['_meta']['hostvars'][host_name]['group'] = host['group']
-                data['_meta']['hostvars'][host_name]['state'] = host['state']
-                data['_meta']['hostvars'][host_name]['service_offering'] = host['serviceofferingname']
-                data['_meta']['hostvars'][host_name]['affinity_group'] = host['affinitygroup']
-                data['_meta']['hostvars'][host_name]['security_group'] = host['securitygroup']
-                data['_meta']['hostvars'][host_name]['cpu_number'] = host['cpunumber']
-                data['_meta']['hostvars'][host_name]['cpu_speed'] = host['cpuspeed']
-                if 'cpuused' in host:
-                    data['_meta']['hostvars'][host_name]['cpu_used'] = host['cpuused']
-                data['_meta']['hostvars'][host_name]['memory'] = host['memory']
-                data['_meta']['hostvars'][host_name]['tags'] = host['tags']
-                data['_meta']['hostvars'][host_name]['hypervisor'] = host['hypervisor']
-                data['_meta']['hostvars'][host_name]['created'] = host['created']
-                data['_meta']['hostvars'][host_name]['nic'] = []
-                for nic in host['nic']:
-                    data['_meta']['hostvars'][host_name]['nic'].append({
-                        'ip': nic['ipaddress'],
-                        'mac': nic['macaddress'],
-                        'netmask': nic['netmask'],
-                        'gateway': nic['gateway'],
-                        'type': nic['type'],
-                        })
-                    if nic['isdefault']:
-                        data['_meta']['hostvars'][host_name]['default_ip'] = nic['ipaddress']
-
-                group_name = ''
-                if 'group' in host:
-                    group_name = host['group']
-
-                if group_name and group_name in data:
-                    data[group_name]['hosts'].append(host_name)
+
+    def get_list(self, project_id='', stream=None, cs=None, extra_groups=None, host_ids=None):
+        data = self.new_list()
+
+        # The groups are made from the hosts, instance groups without hosts are omitted
+        for host in self.get_hosts(project_id, cs):
+            host_name, group_names = self.add_host(data, host, stream, extra_groups)
+            if host_ids is not None:
+                host_ids[host['id']] = (host_name, group_names)
         return data
 
 
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+# Used by the modules as:
+#
+#   from ansible.module_utils.ansible_cloudstack import *
+#
+# The API broker client, the rate limiter, the profiler and the tracer are
+# imported by AnsibleCloudStack only if they are used.
+import os as _os
+
+# Started before the arguments are parsed to profile the whole run
+if _os.environ.get('CLOUDSTACK_PROFILE_DIR'):
+    from ansible.module_utils.ansible_cloudstack.profiling import CloudStackProfiler
+    CloudStackProfiler.start(_os.environ['CLOUDSTACK_PROFILE_DIR'], _os.environ.get('CLOUDSTACK_PROFILE_FORMAT', 'pstats'))
+
+from ansible.module_utils.ansible_cloudstack.common import *
+from ansible.module_utils.ansible_cloudstack.api import *
+from ansible.module_utils.ansible_cloudstack.base import *
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import threading
+import time
+
+from ansible.module_utils.ansible_cloudstack.common import *
+
+
+class CloudStackThrottledApi(object):
+    """Wraps the CloudStack client to limit the rate of API calls and to retry
+    throttled calls and reads failing with a transient error."""
+
+    def __init__(self, cs, rate_limiter=None, retries=CS_RETRIES):
+        self._cs = cs
+        self._rate_limiter = rate_limiter
+        self._retries = retries
+        # Set to the statistics of a CloudStackApiProxy wrapping this client
+        self.stats = None
+
+
+    def _is_throttled(self, e):
+        """Return True if the call was rejected by the API limit, safe to retry any command."""
+        status = getattr(getattr(e, 'response', None), 'status_code', None)
+        text = "%s %s" % (e, getattr(e, 'error', ''))
+        return status == 429 or 'api.throttling' in text or 'HTTP 429' in text
+
+
+    def _is_transient(self, e):
+        """Return True for errors a read may be retried after, e.g. a 503 of an overloaded API."""
+        if has_lib_requests and isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return True
+        status = getattr(getattr(e, 'response', None), 'status_code', None)
+        return (status is not None and status >= 500) or 'HTTP 503' in str(e)
+
+
+    def _add_stat(self, key, value):
+        if self.stats is not None:
+            self.stats[key] += value
+
+
+    def __getattr__(self, name):
+        attr = getattr(self._cs, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(**args):
+            interval = CS_RETRY_INTERVAL
+            retries = self._retries
+            while True:
+                if self._rate_limiter is not None:
+                    self._add_stat('rate_limit_sleep', self._rate_limiter.acquire())
+                try:
+                    return attr(**args)
+                except Exception as e:
+                    retry = self._is_throttled(e) or (name.startswith(CS_IDEMPOTENT_PREFIXES) and self._is_transient(e))
+                    if not retry or retries <= 0:
+                        raise
+                retries -= 1
+                self._add_stat('retries', 1)
+                time.sleep(interval * random.uniform(1 - CS_POLL_JITTER, 1 + CS_POLL_JITTER))
+                interval = min(interval * CS_RETRY_BACKOFF, CS_RETRY_INTERVAL_MAX)
+        return call
+
+
+class CloudStackApiProxy(object):
+    """Wraps the CloudStack client to record statistics of every API call."""
+
+    def __init__(self, cs):
+        self._cs = cs
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.stats = {
+            'calls': 0,
+            'time': 0.0,
+            'bytes': 0,
+            'poll_sleep': 0.0,
+            'rate_limit_sleep': 0.0,
+            'retries': 0,
+            'commands': {},
+        }
+        # Bytes received are only known if the client uses our session, None otherwise
+        session = getattr(cs, 'session', None)
+        self._has_bytes = hasattr(session, 'response_callbacks')
+        if self._has_bytes:
+            session.response_callbacks.append(self._count_bytes)
+        else:
+            self.stats['bytes'] = None
+
+
+    def _count_bytes(self, response):
+        self._local.bytes = getattr(self._local, 'bytes', 0) + len(response.content)
+
+
+    def _record(self, command, duration, received):
+        with self._lock:
+            if command not in self.stats['commands']:
+                self.stats['commands'][command] = {
+                    'calls': 0,
+                    'time': 0.0,
+                    'bytes': 0 if self._has_bytes else None,
+                }
+            for stats in [self.stats, self.stats['commands'][command]]:
+                stats['calls'] += 1
+                stats['time'] += duration
+                if self._has_bytes:
+                    stats['bytes'] += received
+
+
+    def __getattr__(self, name):
+        attr = getattr(self._cs, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(**args):
+            self._local.bytes = 0
+            start = time.time()
+            try:
+                return attr(**args)
+            finally:
+                self._record(name, time.time() - start, self._local.bytes)
+        return call
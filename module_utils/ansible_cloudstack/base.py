@@ -0,0 +1,1017 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import functools
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import time
+
+from ansible.module_utils.ansible_cloudstack.common import *
+from ansible.module_utils.ansible_cloudstack.api import CloudStackApiProxy, CloudStackThrottledApi
+
+
+class CloudStackNullSpan(object):
+    """Stands in for a trace span if tracing is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+def cs_trace(memo=None):
+    """Trace a span per call of a resolver if tracing is enabled.
+
+    Calls answered from the attribute named memo, set by an earlier call,
+    are not traced. Spans of calls without API calls, e.g. as the parameter
+    of the resolver is not set, are not written.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def traced(self, *args, **kwargs):
+            if self._tracer is None or (memo and getattr(self, memo)):
+                return method(self, *args, **kwargs)
+            with self._tracer.span(method.__name__, 'resolver', lazy=True):
+                return method(self, *args, **kwargs)
+        return traced
+    return decorator
+
+
+class AnsibleCloudStack(object):
+
+    def __init__(self, module):
+        if not has_lib_cs:
+            module.fail_json(msg="python library cs required: pip install cs")
+
+        self.result = {
+            'changed': False,
+            'diff' : {
+                'before': dict(),
+                'after': dict()
+            }
+        }
+
+        # Common returns, will be merged with self.returns
+        # search_for_key: replace_with_key
+        self.common_returns = {
+            'id':           'id',
+            'name':         'name',
+            'created':      'created',
+            'zonename':     'zone',
+            'state':        'state',
+            'project':      'project',
+            'account':      'account',
+            'domain':       'domain',
+            'displaytext':  'display_text',
+            'displayname':  'display_name',
+            'description':  'description',
+        }
+
+        # Init returns dict for use in subclasses
+        self.returns = {}
+        # these values will be casted to int
+        self.returns_to_int = {}
+        # these keys will be compared case sensitive in self.has_changed()
+        self.case_sensitive_keys = [
+            'id',
+            'displaytext',
+            'displayname',
+            'description',
+        ]
+
+        self.module = module
+        self._start_profiler()
+        self._tracer = self._get_tracer()
+        self._connect()
+
+        # Rate limit shared by all runs, retries of throttled calls and failed reads
+        throttled_api = CloudStackThrottledApi(self.cs, self._get_rate_limiter(), self.module.params.get('api_retries'))
+        self.cs = throttled_api
+
+        # Optional statistics of the API calls, returned in the result
+        self.api_stats = None
+        api_stats = self.module.params.get('api_stats')
+        if api_stats or os.environ.get('CLOUDSTACK_API_STATS', '').lower() in ['1', 'true', 'yes']:
+            self.cs = CloudStackApiProxy(self.cs)
+            self.api_stats = self.cs.stats
+            throttled_api.stats = self.api_stats
+
+        # Optional trace spans of the API calls, resolvers and job waits
+        if self._tracer is not None:
+            from ansible.module_utils.ansible_cloudstack.tracing import CloudStackTracedApi
+            self.cs = CloudStackTracedApi(self.cs, self._tracer)
+
+        # Optional on disk cache for slow changing lookups
+        self._cache_dir = self._get_cache_dir()
+        # Async jobs of writes: command, the cache is invalidated again when they finish
+        self._cache_jobs = {}
+        self._page_size = self._get_page_size()
+
+        # Helper for VPCs
+        self._vpc_networks_ids = None
+
+        self.domain = None
+        self.account = None
+        self.project = None
+        self.ip_address = None
+        self.network = None
+        self.vpc = None
+        self.zone = None
+        self.vm = None
+        self.vm_default_nic = None
+        self.os_type = None
+        self.hypervisor = None
+        self.capabilities = None
+
+
+    def _start_profiler(self):
+        profile_dir = self.module.params.get('api_profile_dir') or os.environ.get('CLOUDSTACK_PROFILE_DIR')
+        if not profile_dir:
+            return
+        from ansible.module_utils.ansible_cloudstack.profiling import CloudStackProfiler
+        profile_format = self.module.params.get('api_profile_format') or os.environ.get('CLOUDSTACK_PROFILE_FORMAT', 'pstats')
+        profiler = CloudStackProfiler.start(profile_dir, profile_format)
+        # Name the profile after the module, the script name may be a wrapper
+        module_name = getattr(self.module, '_name', None)
+        if module_name:
+            profiler.name = module_name
+
+
+    def _get_tracer(self):
+        trace_file = self.module.params.get('api_trace_file') or os.environ.get('CLOUDSTACK_TRACE_FILE')
+        if not trace_file:
+            return None
+        from ansible.module_utils.ansible_cloudstack.tracing import CloudStackTracer
+        name = getattr(self.module, '_name', None) or os.path.basename(sys.argv[0]).replace('.py', '')
+        return CloudStackTracer(trace_file, name)
+
+
+    def _span(self, name, category, **args):
+        if self._tracer is None:
+            return CloudStackNullSpan()
+        return self._tracer.span(name, category, **args)
+
+
+    def _connect(self):
+        api_key = self.module.params.get('api_key')
+        api_secret = self.module.params.get('api_secret')
+        api_url = self.module.params.get('api_url')
+        api_http_method = self.module.params.get('api_http_method')
+        api_timeout = self.module.params.get('api_timeout')
+
+        if api_key and api_secret and api_url:
+            config = {
+                'endpoint': api_url,
+                'key': api_key,
+                'secret': api_secret,
+                'timeout': api_timeout,
+                'method': api_http_method,
+            }
+        else:
+            api_region = self.module.params.get('api_region', 'cloudstack')
+            config = read_config(api_region)
+
+        self.cs = None
+        broker = self.module.params.get('api_broker') or os.environ.get('CLOUDSTACK_BROKER')
+        if broker:
+            import socket
+            from ansible.module_utils.ansible_cloudstack.broker import CloudStackBrokerClient
+            try:
+                self.cs = CloudStackBrokerClient(os.path.expanduser(broker), config)
+            except socket.error:
+                # The broker is optional, talk to the API directly if it is not running
+                self.cs = None
+        if self.cs is None and has_lib_requests:
+            try:
+                self.cs = CloudStack(session=self._get_session(), **config)
+            except TypeError:
+                # cs < 2.7.1 does not take a session and connects per request
+                pass
+        if self.cs is None:
+            self.cs = CloudStack(**config)
+
+        # requests takes a tuple of connect and read timeout
+        timeout = int(config.get('timeout') or api_timeout)
+        self.cs.timeout = (
+            self.module.params.get('api_connect_timeout') or timeout,
+            self.module.params.get('api_read_timeout') or timeout,
+        )
+
+
+    def _get_page_size(self):
+        page_size = self.module.params.get('api_page_size') or os.environ.get('CLOUDSTACK_PAGE_SIZE')
+        if not page_size:
+            return CS_PAGE_SIZE
+        try:
+            if int(page_size) > 0:
+                return int(page_size)
+        except ValueError:
+            pass
+        self.module.fail_json(msg="Invalid API page size: %s" % page_size)
+
+
+    def _get_rate_limiter(self):
+        rate_limit = self.module.params.get('api_rate_limit') or os.environ.get('CLOUDSTACK_API_RATE_LIMIT')
+        if not rate_limit:
+            return None
+        try:
+            rate_limit = float(rate_limit)
+        except ValueError:
+            self.module.fail_json(msg="Invalid API rate limit: %s" % rate_limit)
+        if rate_limit <= 0:
+            return None
+
+        from ansible.module_utils.ansible_cloudstack.ratelimit import CloudStackRateLimiter
+
+        # The limit is shared by all runs of the user using the same endpoint and API key
+        state_dir = os.path.expanduser(CS_RATE_STATE_DIR)
+        try:
+            os.makedirs(state_dir, 0o700)
+        except OSError:
+            # Created by a concurrent run
+            if not os.path.isdir(state_dir):
+                self.module.fail_json(msg="Could not create the directory of the API rate limit: %s" % state_dir)
+        scope = hashlib.sha1(("%s|%s" % (self.cs.endpoint, self.cs.key)).encode('utf-8')).hexdigest()
+        state_file = os.path.join(state_dir, 'ansible-cloudstack-rate-%s' % scope[:12])
+        return CloudStackRateLimiter(rate_limit, state_file)
+
+
+    def _get_session(self):
+        pool_size = self.module.params.get('api_pool_size')
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session = CloudStackSession()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+
+    def _get_cache_dir(self):
+        cache_dir = self.module.params.get('api_cache_dir')
+        if not cache_dir:
+            cache_dir = os.environ.get('CLOUDSTACK_CACHE_DIR')
+        if not cache_dir:
+            return None
+
+        # Results are only shared between runs using the same endpoint and API key
+        scope = hashlib.sha1(("%s|%s" % (self.cs.endpoint, self.cs.key)).encode('utf-8')).hexdigest()
+        return os.path.join(os.path.expanduser(cache_dir), scope)
+
+
+    def _get_cache_file(self, command, args):
+        args_hash = hashlib.sha1(json.dumps(args, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self._cache_dir, command, args_hash + '.json')
+
+
+    def _read_cache(self, cache_file, ttl):
+        try:
+            if time.time() - os.path.getmtime(cache_file) > ttl:
+                return None
+            with open(cache_file) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+
+    def _write_cache(self, cache_file, res):
+        cache_dir = os.path.dirname(cache_file)
+        try:
+            os.makedirs(cache_dir, 0o700)
+        except OSError:
+            # Created by a concurrent run
+            if not os.path.isdir(cache_dir):
+                return
+
+        import tempfile
+        tmp_file = None
+        try:
+            fd, tmp_file = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(res, f)
+            # rename is atomic, concurrent readers never see a partial file
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError):
+            if tmp_file and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+
+    def _get_cache_generation(self, list_command):
+        """Return the generation of the cached results of a list command, changed by every invalidation."""
+        try:
+            with open(os.path.join(self._cache_dir, list_command, 'generation')) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return ''
+
+
+    def _invalidate_cache(self, command):
+        for list_command in CS_CACHE_TTL:
+            # e.g. createZone, updateZone and deleteZone invalidate listZones
+            resource = list_command[len('list'):].rstrip('s')
+            if resource not in command:
+                continue
+
+            # Results fetched before the new generation are never served,
+            # even if written back by a concurrent run afterwards.
+            self._write_cache(os.path.join(self._cache_dir, list_command, 'generation'), '%016x' % random.getrandbits(64))
+
+
+    def _invalidate_cache_of_job(self, job):
+        command = self._cache_jobs.pop(job.get('jobid'), None)
+        if command:
+            # Lists fetched while the job was running are outdated now
+            self._invalidate_cache(command)
+
+
+    def query_api(self, command, **args):
+        """Call an API command, slow changing lookups are served from the on disk cache if enabled."""
+        ttl = CS_CACHE_TTL.get(command)
+        if self._cache_dir and ttl:
+            cache_file = self._get_cache_file(command, args)
+            generation = self._get_cache_generation(command)
+            cached = self._read_cache(cache_file, ttl)
+            if isinstance(cached, dict) and cached.get('generation') == generation and 'result' in cached:
+                return cached['result']
+            res = getattr(self.cs, command)(**args)
+            if 'errortext' not in res:
+                self._write_cache(cache_file, {'generation': generation, 'result': res})
+            return res
+
+        res = getattr(self.cs, command)(**args)
+        if self._cache_dir and not command.startswith('list'):
+            self._invalidate_cache(command)
+            if 'jobid' in res:
+                self._cache_jobs[res['jobid']] = command
+        return res
+
+
+    def iter_api(self, command, pagesize=None, **args):
+        """Yield the items of a list API command, fetched page by page."""
+        args['pagesize'] = pagesize or self._page_size
+        args['page'] = 1
+        fetched = 0
+        while True:
+            try:
+                res = self.query_api(command, **args)
+            except CloudStackException as e:
+                if not self._fall_back_page_size(args, "%s %s" % (e, getattr(e, 'error', ''))):
+                    raise
+                continue
+            if 'errortext' in res and self._fall_back_page_size(args, res['errortext']):
+                continue
+
+            items = []
+            for value in res.values():
+                if isinstance(value, list):
+                    items = value
+                    break
+
+            for item in items:
+                yield item
+
+            fetched += len(items)
+            if len(items) < args['pagesize'] or fetched >= res.get('count', 0):
+                break
+            args['page'] += 1
+
+
+    def _fall_back_page_size(self, args, error):
+        """Lower the page size of a list to the max the API reports in the error, returns True to list again."""
+        match = re.search(r'max allowed page size value: (\d+)', error)
+        if not match or args['page'] != 1 or int(match.group(1)) >= args['pagesize']:
+            return False
+        # The API has a lower default.page.size, following lists use it too
+        self._page_size = args['pagesize'] = int(match.group(1))
+        return True
+
+
+    def find_resource(self, resources, value, keys=None):
+        """Return the first resource matching the value like CloudStackResourceIndex does."""
+        index = CloudStackResourceIndex(keys=keys)
+        for resource in resources:
+            index.add(resource)
+            found = index.get(value)
+            if found:
+                return found
+        return None
+
+
+    def get_filter_args(self, value, name_key='name'):
+        """Return the args to let the API filter a resource by id or name."""
+        if CS_UUID_RE.match(value):
+            return {'id': value}
+        return {name_key: value}
+
+
+    def _run_concurrently(self, lookups):
+        if len(lookups) < 2:
+            for lookup in lookups:
+                lookup()
+            return
+
+        # Most runs need no threads, import the pool only when needed
+        from multiprocessing.pool import ThreadPool
+
+        # fail_json() exits, which would kill the worker thread, let the
+        # main thread fail instead.
+        fail_json = self.module.fail_json
+
+        def fail_in_thread(**kwargs):
+            raise CloudStackLookupFailed(kwargs)
+
+        self.module.fail_json = fail_in_thread
+        if self._tracer is not None:
+            # Spans of the threads are children of the current span
+            lookups = [self._tracer.wrap(lookup) for lookup in lookups]
+        pool = ThreadPool(min(len(lookups), CS_LOOKUP_WORKERS))
+        try:
+            results = [pool.apply_async(lookup) for lookup in lookups]
+            for result in results:
+                result.get()
+        except CloudStackLookupFailed as e:
+            self.module.fail_json = fail_json
+            self.module.fail_json(**e.kwargs)
+        finally:
+            self.module.fail_json = fail_json
+            pool.close()
+            pool.join()
+
+
+    @cs_trace()
+    def resolve_lookups(self, lookups=None, scoped_lookups=None):
+        """Run lookups not depending on each other concurrently.
+
+        The domain, account and project are resolved one after the other, at
+        the same time as the zone and the given lookups which do not depend on
+        them. The scoped lookups, e.g. of templates or networks, depend on the
+        project, zone and VPC and run once those are resolved.
+        """
+        def resolve_scope():
+            self.get_domain()
+            self.get_account()
+            self.get_project()
+
+        self._run_concurrently([resolve_scope, self.get_zone] + list(lookups or []))
+        self.get_vpc()
+        self._run_concurrently(list(scoped_lookups or []))
+
+
+    def get_or_fallback(self, key=None, fallback_key=None):
+        value = self.module.params.get(key)
+        if not value:
+            value = self.module.params.get(fallback_key)
+        return value
+
+
+    # TODO: for backward compatibility only, remove if not used anymore
+    def _has_changed(self, want_dict, current_dict, only_keys=None):
+        return self.has_changed(want_dict=want_dict, current_dict=current_dict, only_keys=only_keys)
+
+
+    def has_changed(self, want_dict, current_dict, only_keys=None):
+        result = False
+        for key, value in want_dict.iteritems():
+
+            # Optionally limit by a list of keys
+            if only_keys and key not in only_keys:
+                continue
+
+            # Skip None values
+            if value is None:
+                continue
+
+            if key in current_dict:
+                if isinstance(value, (int, float, long, complex)):
+                    # ensure we compare the same type
+                    if isinstance(value, int):
+                        current_dict[key] = int(current_dict[key])
+                    elif isinstance(value, float):
+                        current_dict[key] = float(current_dict[key])
+                    elif isinstance(value, long):
+                        current_dict[key] = long(current_dict[key])
+                    elif isinstance(value, complex):
+                        current_dict[key] = complex(current_dict[key])
+
+                    if value != current_dict[key]:
+                        self.result['diff']['before'][key] = current_dict[key]
+                        self.result['diff']['after'][key] = value
+                        result = True
+                else:
+                    if self.case_sensitive_keys and key in self.case_sensitive_keys:
+                        if value != current_dict[key].encode('utf-8'):
+                            self.result['diff']['before'][key] = current_dict[key].encode('utf-8')
+                            self.result['diff']['after'][key] = value
+                            result = True
+
+                    # Test for diff in case insensitive way
+                    elif value.lower() != current_dict[key].encode('utf-8').lower():
+                        self.result['diff']['before'][key] = current_dict[key].encode('utf-8')
+                        self.result['diff']['after'][key] = value
+                        result = True
+            else:
+                self.result['diff']['before'][key] = None
+                self.result['diff']['after'][key] = value
+                result = True
+        return result
+
+
+    def _get_by_key(self, key=None, my_dict=None):
+        if my_dict is None:
+            my_dict = {}
+        if key:
+            if key in my_dict:
+                return my_dict[key]
+            self.module.fail_json(msg="Something went wrong: %s not found" % key)
+        return my_dict
+
+
+    @cs_trace('vpc')
+    def get_vpc(self, key=None):
+        """Return a VPC dictionary or the value of given key of."""
+        if self.vpc:
+            return self._get_by_key(key, self.vpc)
+
+        vpc = self.module.params.get('vpc')
+        if not vpc:
+            vpc = os.environ.get('CLOUDSTACK_VPC')
+        if not vpc:
+            return None
+
+        args = {
+            'account': self.get_account(key='name'),
+            'domainid': self.get_domain(key='id'),
+            'projectid': self.get_project(key='id'),
+            'zoneid': self.get_zone(key='id'),
+        }
+        self.vpc = self.find_resource(self.iter_api('listVPCs', **args), vpc)
+        if self.vpc:
+            return self._get_by_key(key, self.vpc)
+        self.module.fail_json(msg="VPC '%s' not found" % vpc)
+
+
+    def is_vm_in_vpc(self, vm):
+        for n in vm.get('nic'):
+            if n.get('isdefault', False):
+                return self.is_vpc_network(network_id=n['networkid'])
+        self.module.fail_json(msg="VM has no default nic")
+
+
+    def is_vpc_network(self, network_id):
+        """Returns True if network is in VPC."""
+        # This is an efficient way to query a lot of networks at a time
+        if self._vpc_networks_ids is None:
+            args = {
+                'account': self.get_account(key='name'),
+                'domainid': self.get_domain(key='id'),
+                'projectid': self.get_project(key='id'),
+                'zoneid': self.get_zone(key='id'),
+            }
+            self._vpc_networks_ids = set()
+            for vpc in self.iter_api('listVPCs', **args):
+                for n in vpc.get('network',[]):
+                    self._vpc_networks_ids.add(n['id'])
+        return network_id in self._vpc_networks_ids
+
+
+    @cs_trace('network')
+    def get_network(self, key=None):
+        """Return a network dictionary or the value of given key of."""
+        if self.network:
+            return self._get_by_key(key, self.network)
+
+        network = self.module.params.get('network')
+        if not network:
+            return None
+
+        args = {
+            'account': self.get_account(key='name'),
+            'domainid': self.get_domain(key='id'),
+            'projectid': self.get_project(key='id'),
+            'zoneid': self.get_zone(key='id'),
+            'vpcid': self.get_vpc(key='id')
+        }
+        # The API has no name filter for networks, the keyword matches the name.
+        # Only fall back to list all networks for display text matches.
+        for filter_args in [self.get_filter_args(network, name_key='keyword'), {}]:
+            filter_args.update(args)
+            # ignore any VPC network if vpc param is not given
+            networks = (n for n in self.iter_api('listNetworks', **filter_args) if 'vpcid' not in n or args['vpcid'])
+            self.network = self.find_resource(networks, network)
+            if self.network:
+                return self._get_by_key(key, self.network)
+        self.module.fail_json(msg="Network '%s' not found" % network)
+
+
+    @cs_trace('project')
+    def get_project(self, key=None):
+        if self.project:
+            return self._get_by_key(key, self.project)
+
+        project = self.module.params.get('project')
+        if not project:
+            project = os.environ.get('CLOUDSTACK_PROJECT')
+        if not project:
+            return None
+        args = self.get_filter_args(project)
+        args['account'] = self.get_account(key='name')
+        args['domainid'] = self.get_domain(key='id')
+        self.project = self.find_resource(self.iter_api('listProjects', **args), project, keys=['name'])
+        if self.project:
+            return self._get_by_key(key, self.project)
+        self.module.fail_json(msg="project '%s' not found" % project)
+
+
+    @cs_trace('ip_address')
+    def get_ip_address(self, key=None):
+        if self.ip_address:
+            return self._get_by_key(key, self.ip_address)
+
+        ip_address = self.module.params.get('ip_address')
+        if not ip_address:
+            self.module.fail_json(msg="IP address param 'ip_address' is required")
+
+        args = {
+            'ipaddress': ip_address,
+            'account': self.get_account(key='name'),
+            'domainid': self.get_domain(key='id'),
+            'projectid': self.get_project(key='id'),
+            'vpcid': self.get_vpc(key='id'),
+        }
+        self.ip_address = next(self.iter_api('listPublicIpAddresses', **args), None)
+        if not self.ip_address:
+            self.module.fail_json(msg="IP address '%s' not found" % args['ipaddress'])
+        return self._get_by_key(key, self.ip_address)
+
+
+    def get_vm_guest_ip(self):
+        vm_guest_ip = self.module.params.get('vm_guest_ip')
+        default_nic = self.get_vm_default_nic()
+
+        if not vm_guest_ip:
+            return default_nic['ipaddress']
+
+        for secondary_ip in default_nic['secondaryip']:
+            if vm_guest_ip == secondary_ip['ipaddress']:
+                return vm_guest_ip
+        self.module.fail_json(msg="Secondary IP '%s' not assigned to VM" % vm_guest_ip)
+
+
+    def get_vm_default_nic(self):
+        if self.vm_default_nic:
+            return self.vm_default_nic
+
+        for n in self.iter_api('listNics', virtualmachineid=self.get_vm(key='id')):
+            if n['isdefault']:
+                self.vm_default_nic = n
+                return self.vm_default_nic
+        self.module.fail_json(msg="No default IP address of VM '%s' found" % self.module.params.get('vm'))
+
+
+    @cs_trace('vm')
+    def get_vm(self, key=None):
+        if self.vm:
+            return self._get_by_key(key, self.vm)
+
+        vm = self.module.params.get('vm')
+        if not vm:
+            self.module.fail_json(msg="Virtual machine param 'vm' is required")
+
+        vpc_id = self.get_vpc(key='id')
+
+        args = {
+            'account': self.get_account(key='name'),
+            'domainid': self.get_domain(key='id'),
+            'projectid': self.get_project(key='id'),
+            'zoneid': self.get_zone(key='id'),
+            'vpcid': vpc_id,
+        }
+        # Filter by id or name first, the keyword also matches the display name.
+        for filter_args in [self.get_filter_args(vm), {'keyword': vm}]:
+            filter_args.update(args)
+            # Due the limitation of the API, there is no easy way (yet) to get only those VMs
+            # not belonging to a VPC.
+            vms = (v for v in self.iter_api('listVirtualMachines', **filter_args) if vpc_id or not self.is_vm_in_vpc(vm=v))
+            self.vm = self.find_resource(vms, vm, keys=['name', 'displayname'])
+            if self.vm:
+                return self._get_by_key(key, self.vm)
+        self.module.fail_json(msg="Virtual machine '%s' not found" % vm)
+
+
+    @cs_trace('zone')
+    def get_zone(self, key=None):
+        if self.zone:
+            return self._get_by_key(key, self.zone)
+
+        zone = self.module.params.get('zone')
+        if not zone:
+            zone = os.environ.get('CLOUDSTACK_ZONE')
+
+        # use the first zone if no zone param given
+        if not zone:
+            zones = self.query_api('listZones')
+            self.zone = zones['zone'][0]
+            return self._get_by_key(key, self.zone)
+
+        self.zone = self.find_resource(self.iter_api('listZones', **self.get_filter_args(zone)), zone, keys=['name'])
+        if self.zone:
+            return self._get_by_key(key, self.zone)
+        self.module.fail_json(msg="zone '%s' not found" % zone)
+
+
+    @cs_trace('os_type')
+    def get_os_type(self, key=None):
+        if self.os_type:
+            return self._get_by_key(key, self.zone)
+
+        os_type = self.module.params.get('os_type')
+        if not os_type:
+            return None
+
+        self.os_type = self.find_resource(self.iter_api('listOsTypes'), os_type, keys=['description'])
+        if self.os_type:
+            return self._get_by_key(key, self.os_type)
+        self.module.fail_json(msg="OS type '%s' not found" % os_type)
+
+
+    @cs_trace('hypervisor')
+    def get_hypervisor(self):
+        if self.hypervisor:
+            return self.hypervisor
+
+        hypervisor = self.module.params.get('hypervisor')
+        hypervisors = self.query_api('listHypervisors')
+
+        # use the first hypervisor if no hypervisor param given
+        if not hypervisor:
+            self.hypervisor = hypervisors['hypervisor'][0]['name']
+            return self.hypervisor
+
+        for h in hypervisors['hypervisor']:
+            if hypervisor.lower() == h['name'].lower():
+                self.hypervisor = h['name']
+                return self.hypervisor
+        self.module.fail_json(msg="Hypervisor '%s' not found" % hypervisor)
+
+
+    @cs_trace('account')
+    def get_account(self, key=None):
+        if self.account:
+            return self._get_by_key(key, self.account)
+
+        account = self.module.params.get('account')
+        if not account:
+            account = os.environ.get('CLOUDSTACK_ACCOUNT')
+        if not account:
+            return None
+
+        domain = self.module.params.get('domain')
+        if not domain:
+            self.module.fail_json(msg="Account must be specified with Domain")
+
+        args = {}
+        args['name'] = account
+        args['domainid'] = self.get_domain(key='id')
+        args['listall'] = True
+        accounts = self.query_api('listAccounts', **args)
+        if accounts:
+            self.account = accounts['account'][0]
+            return self._get_by_key(key, self.account)
+        self.module.fail_json(msg="Account '%s' not found" % account)
+
+
+    @cs_trace('domain')
+    def get_domain(self, key=None):
+        if self.domain:
+            return self._get_by_key(key, self.domain)
+
+        domain = self.module.params.get('domain')
+        if not domain:
+            domain = os.environ.get('CLOUDSTACK_DOMAIN')
+        if not domain:
+            return None
+
+        args = {}
+        args['listall'] = True
+        for d in self.iter_api('listDomains', **args):
+            if d['path'].lower() in [ domain.lower(), "root/" + domain.lower(), "root" + domain.lower() ]:
+                self.domain = d
+                return self._get_by_key(key, self.domain)
+        self.module.fail_json(msg="Domain '%s' not found" % domain)
+
+
+    def get_tags(self, resource=None):
+        existing_tags = []
+        for tag in resource.get('tags',[]):
+            existing_tags.append({'key': tag['key'], 'value': tag['value']})
+        return existing_tags
+
+
+    def _get_tags_index(self, tags):
+        return set((tag['key'], tag['value']) for tag in tags)
+
+
+    def _process_tags(self, resource, resource_type, tags, operation="create", poll=True):
+        if tags:
+            self.result['changed'] = True
+            if not self.module.check_mode:
+                args = {}
+                args['resourceids']  = resource['id']
+                args['resourcetype'] = resource_type
+                args['tags']         = tags
+                if operation == "create":
+                    response = self.cs.createTags(**args)
+                else:
+                    response = self.cs.deleteTags(**args)
+                if not poll:
+                    return response
+                self.poll_job(response)
+        return None
+
+
+    def _tags_that_should_exist_or_be_updated(self, resource, tags):
+        existing_tags = self._get_tags_index(self.get_tags(resource))
+        return [tag for tag in tags if (tag['key'], tag['value']) not in existing_tags]
+
+
+    def _tags_that_should_not_exist(self, resource, tags):
+        wanted_tags = self._get_tags_index(tags)
+        return [tag for tag in self.get_tags(resource) if (tag['key'], tag['value']) not in wanted_tags]
+
+
+    def ensure_tags(self, resource, resource_type=None):
+        if not resource_type or not resource:
+            self.module.fail_json(msg="Error: Missing resource or resource_type for tags.")
+
+        if 'tags' in resource:
+            tags = self.module.params.get('tags')
+            if tags is not None:
+                tags_to_delete = self._tags_that_should_not_exist(resource, tags)
+                tags_to_create = self._tags_that_should_exist_or_be_updated(resource, tags)
+
+                # Updated tags must be deleted before they are created again,
+                # otherwise both jobs run at the same time.
+                if set(t['key'] for t in tags_to_delete) & set(t['key'] for t in tags_to_create):
+                    self._process_tags(resource, resource_type, tags_to_delete, operation="delete")
+                    self._process_tags(resource, resource_type, tags_to_create)
+                else:
+                    jobs = [
+                        self._process_tags(resource, resource_type, tags_to_delete, operation="delete", poll=False),
+                        self._process_tags(resource, resource_type, tags_to_create, poll=False),
+                    ]
+                    for job, res in self.poll_jobs([j for j in jobs if j]):
+                        pass
+                resource['tags'] = tags
+        return resource
+
+
+    @cs_trace('capabilities')
+    def get_capabilities(self, key=None):
+        if self.capabilities:
+            return self._get_by_key(key, self.capabilities)
+        capabilities = self.query_api('listCapabilities')
+        self.capabilities = capabilities['capability']
+        return self._get_by_key(key, self.capabilities)
+
+
+    # TODO: for backward compatibility only, remove if not used anymore
+    def _poll_job(self, job=None, key=None):
+        return self.poll_job(job=job, key=key)
+
+
+    def _get_poll_deadline(self):
+        poll_timeout = self.module.params.get('poll_timeout')
+        if poll_timeout:
+            return time.time() + poll_timeout
+        return None
+
+
+    def _poll_sleep(self, interval, deadline=None):
+        """Sleep for a jittered interval, returns the next interval or None if the deadline is passed.
+
+        The last sleep is cut to the deadline, to poll once more at the deadline.
+        """
+        sleep = interval * random.uniform(1 - CS_POLL_JITTER, 1 + CS_POLL_JITTER)
+        if deadline:
+            time_left = deadline - time.time()
+            if time_left <= 0:
+                return None
+            sleep = min(sleep, time_left)
+        time.sleep(sleep)
+        if self.api_stats is not None:
+            self.api_stats['poll_sleep'] += sleep
+        return min(interval * CS_POLL_BACKOFF, CS_POLL_INTERVAL_MAX)
+
+
+    def _fail_poll_timeout(self, job, res):
+        self.module.fail_json(msg="Timeout after %ss waiting for job %s on %s '%s'" % (
+            self.module.params.get('poll_timeout'),
+            job['jobid'],
+            res.get('jobinstancetype', 'resource'),
+            res.get('jobinstanceid', job.get('id')),
+        ))
+
+
+    def _get_job_result(self, job, res, key=None):
+        if 'errortext' in res['jobresult']:
+            self.module.fail_json(msg="Failed: '%s'" % res['jobresult']['errortext'])
+        if key and key in res['jobresult']:
+            return res['jobresult'][key]
+        return job
+
+
+    def poll_job(self, job=None, key=None):
+        if 'jobid' in job:
+            with self._span('poll_job', 'job', jobid=job['jobid']):
+                deadline = self._get_poll_deadline()
+                interval = CS_POLL_INTERVAL
+                while True:
+                    res = self.cs.queryAsyncJobResult(jobid=job['jobid'])
+                    if res['jobstatus'] != 0 and 'jobresult' in res:
+                        self._invalidate_cache_of_job(job)
+                        job = self._get_job_result(job, res, key)
+                        break
+
+                    interval = self._poll_sleep(interval, deadline)
+                    if interval is None:
+                        self._fail_poll_timeout(job, res)
+        return job
+
+
+    def poll_jobs(self, jobs, key=None):
+        """Wait for several async jobs, given in the order they were started.
+
+        Yields tuples of the job and its result as the jobs finish. The jobs
+        run at the same time and share the intervals of the polls.
+        """
+        pending = []
+        for job in jobs:
+            if 'jobid' in job:
+                pending.append(job)
+            else:
+                yield job, job
+
+        start = time.time()
+        deadline = self._get_poll_deadline()
+        interval = CS_POLL_INTERVAL
+        results = {}
+        while pending:
+            for job in pending[:]:
+                res = self.cs.queryAsyncJobResult(jobid=job['jobid'])
+                results[job['jobid']] = res
+                if res['jobstatus'] != 0 and 'jobresult' in res:
+                    pending.remove(job)
+                    self._invalidate_cache_of_job(job)
+                    if self._tracer is not None:
+                        # The generator may be left between two yields, no with block
+                        self._tracer.add_span('poll_jobs', 'job', start, jobid=job['jobid'])
+                    yield job, self._get_job_result(job, res, key)
+
+            if pending:
+                interval = self._poll_sleep(interval, deadline)
+                if interval is None:
+                    self._fail_poll_timeout(pending[0], results[pending[0]['jobid']])
+
+
+    def get_result(self, resource):
+        if resource:
+            returns = self.common_returns.copy()
+            returns.update(self.returns)
+            for search_key, return_key in returns.iteritems():
+                if search_key in resource:
+                    self.result[return_key] = resource[search_key]
+
+            # Bad bad API does not always return int when it should.
+            for search_key, return_key in self.returns_to_int.iteritems():
+                if search_key in resource:
+                    self.result[return_key] = int(resource[search_key])
+
+            # Special handling for tags
+            if 'tags' in resource:
+                self.result['tags'] = []
+                for tag in resource['tags']:
+                    result_tag          = {}
+                    result_tag['key']   = tag['key']
+                    result_tag['value'] = tag['value']
+                    self.result['tags'].append(result_tag)
+
+        if self.api_stats is not None:
+            self.result['api_stats'] = self.api_stats
+        return self.result
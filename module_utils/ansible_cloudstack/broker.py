@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import socket
+import threading
+
+from ansible.module_utils.ansible_cloudstack.common import *
+
+
+if has_lib_cs:
+    class CloudStackBrokerError(CloudStackException):
+        """Error of an API call returned by the broker."""
+
+        def __init__(self, msg):
+            # Unlike the errors of the client there is no response
+            Exception.__init__(self, msg)
+            self.response = None
+
+
+class CloudStackBrokerClient(object):
+    """Client sending the API calls through a local broker (cloudstack-broker.py).
+
+    The broker holds the upstream connections, coalesces identical reads of
+    concurrent module runs and serves them from a short lived cache. Every
+    thread gets its own connection to the broker.
+    """
+
+    def __init__(self, socket_path, config):
+        self.socket_path = socket_path
+        self.config = config
+        self.endpoint = config.get('endpoint')
+        self.key = config.get('key')
+        self.timeout = config.get('timeout')
+        self.session = None
+        self._local = threading.local()
+        # Fail early if the broker is not running
+        self._get_socket()
+
+
+    def _get_socket(self):
+        if getattr(self._local, 'socket', None) is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socket_path)
+            self._local.socket = sock
+            self._local.reader = sock.makefile('rb')
+        # Reads may wait for the same read of another run
+        timeout = self.timeout
+        if isinstance(timeout, tuple):
+            timeout = sum(timeout)
+        if timeout:
+            self._local.socket.settimeout(int(timeout) * 2)
+        return self._local.socket
+
+
+    def __getattr__(self, command):
+        if command.startswith('_'):
+            raise AttributeError(command)
+
+        def call(**args):
+            request = json.dumps({
+                'config': self.config,
+                'command': command,
+                'args': args,
+            })
+            try:
+                self._get_socket().sendall((request + '\n').encode('utf-8'))
+                line = self._local.reader.readline()
+            except socket.error as e:
+                self._local.socket = None
+                raise CloudStackBrokerError("Connection to the broker %s failed: %s" % (self.socket_path, e))
+            if not line:
+                self._local.socket = None
+                raise CloudStackBrokerError("Connection to the broker %s closed" % self.socket_path)
+            response = json.loads(line.decode('utf-8'))
+            if 'error' in response:
+                raise CloudStackBrokerError(response['error'])
+            return response['result']
+        return call
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import re
+
+try:
+    from cs import CloudStack, CloudStackException, read_config
+    has_lib_cs = True
+except ImportError:
+    has_lib_cs = False
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    has_lib_requests = True
+except ImportError:
+    has_lib_requests = False
+
+CS_HYPERVISORS = [
+    "KVM", "kvm",
+    "VMware", "vmware",
+    "BareMetal", "baremetal",
+    "XenServer", "xenserver",
+    "LXC", "lxc",
+    "HyperV", "hyperv",
+    "UCS", "ucs",
+    "OVM", "ovm",
+    "Simulator", "simulator",
+    ]
+
+# Results of these slow changing lookups are cached on disk if api_cache_dir is set.
+# list command: time to live in seconds
+CS_CACHE_TTL = {
+    'listCapabilities': 3600,
+    'listHypervisors':  3600,
+    'listOsTypes':      86400,
+    'listZones':        3600,
+    'listDomains':      600,
+    'listAccounts':     300,
+    'listProjects':     300,
+}
+
+# Default number of items fetched per page of list API commands
+CS_PAGE_SIZE = 500
+
+# Polling of async jobs: first and max interval in seconds, backoff factor
+# and the jitter spreading the polls of concurrent runs
+CS_POLL_INTERVAL = 0.5
+CS_POLL_INTERVAL_MAX = 10
+CS_POLL_BACKOFF = 1.5
+CS_POLL_JITTER = 0.2
+
+# Directory of the state shared by the rate limited runs of a user
+CS_RATE_STATE_DIR = '~/.ansible/tmp'
+
+# Retries of throttled calls and of failed reads: first and max interval in
+# seconds and backoff factor, jittered like the polls
+CS_RETRIES = 3
+CS_RETRY_INTERVAL = 1
+CS_RETRY_INTERVAL_MAX = 30
+CS_RETRY_BACKOFF = 2
+
+# Prefixes of commands safe to retry after any transient error
+CS_IDEMPOTENT_PREFIXES = ('list', 'query')
+
+# Max number of lookups run at the same time by resolve_lookups()
+CS_LOOKUP_WORKERS = 4
+
+CS_UUID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.IGNORECASE)
+
+if has_lib_requests:
+    class CloudStackSession(requests.Session):
+        """Session keeping its pooled connections alive for the whole module run."""
+
+        def __init__(self):
+            super(CloudStackSession, self).__init__()
+            # Called with every response, the client sends prepared requests
+            # which do not run the session hooks.
+            self.response_callbacks = []
+
+        def __exit__(self, *args):
+            # The client uses the session as context manager for every request,
+            # which would close the connections.
+            pass
+
+        def send(self, request, **kwargs):
+            response = super(CloudStackSession, self).send(request, **kwargs)
+            for callback in self.response_callbacks:
+                callback(response)
+            return response
+
+class CloudStackLookupFailed(Exception):
+    """Raised in place of fail_json() by lookups run in a thread."""
+
+    def __init__(self, kwargs):
+        super(CloudStackLookupFailed, self).__init__(kwargs.get('msg'))
+        self.kwargs = kwargs
+
+
+class CloudStackResourceIndex(object):
+    """Index of resources by id and by lower cased name and display text.
+
+    A lookup matches the id first, then the keys in the given order. If
+    several resources share a name or display text, the first one added wins.
+    """
+
+    def __init__(self, resources=None, keys=None):
+        self.keys = keys or ['name', 'displaytext']
+        self.by_id = {}
+        self.by_key = dict((key, {}) for key in self.keys)
+        for resource in resources or []:
+            self.add(resource)
+
+
+    def add(self, resource):
+        self.by_id.setdefault(resource['id'], resource)
+        for key in self.keys:
+            value = resource.get(key)
+            if value:
+                self.by_key[key].setdefault(value.lower(), resource)
+
+
+    def get(self, value):
+        if value in self.by_id:
+            return self.by_id[value]
+        value = value.lower()
+        for key in self.keys:
+            if value in self.by_key[key]:
+                return self.by_key[key][value]
+        return None
+
+
+def cs_argument_spec():
+    return dict(
+        api_key = dict(default=None),
+        api_secret = dict(default=None, no_log=True),
+        api_url = dict(default=None),
+        api_http_method = dict(choices=['get', 'post'], default='get'),
+        api_timeout = dict(type='int', default=10),
+        api_connect_timeout = dict(type='int', default=None),
+        api_read_timeout = dict(type='int', default=None),
+        api_pool_size = dict(type='int', default=10),
+        api_region = dict(default='cloudstack'),
+        api_cache_dir = dict(default=None),
+        api_page_size = dict(type='int', default=None),
+        poll_timeout = dict(type='int', default=None),
+        api_stats = dict(type='bool', default=False),
+        api_broker = dict(default=None),
+        api_rate_limit = dict(type='float', default=None),
+        api_retries = dict(type='int', default=CS_RETRIES),
+        api_profile_dir = dict(default=None),
+        api_profile_format = dict(choices=['pstats', 'collapsed'], default=None),
+        api_trace_file = dict(default=None),
+    )
+
+def cs_required_together():
+    return [['api_key', 'api_secret', 'api_url']]
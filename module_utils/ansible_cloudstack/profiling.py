@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import cProfile
+import os
+import sys
+import threading
+import time
+
+
+class CloudStackStackProfiler(object):
+    """Profiler recording the time spent per call stack of all threads.
+
+    Written in the collapsed format of flamegraph.pl, a line per stack with
+    the microseconds spent in its innermost frame:
+
+      main (cs_zone.py:1584);present_zone (cs_zone.py:1420) 1250
+    """
+
+    def __init__(self):
+        self.stacks = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+
+    def _get_frame_name(self, frame):
+        code = frame.f_code
+        return "%s (%s:%s)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+    def _profile(self, frame, event, arg):
+        now = time.time()
+        local = self._local
+        if not hasattr(local, 'frames'):
+            # Frames of the stack and their names, None for builtins
+            local.frames = []
+            local.names = []
+        elif local.names:
+            key = ';'.join(local.names)
+            with self._lock:
+                self.stacks[key] = self.stacks.get(key, 0) + now - local.last
+
+        if event == 'call':
+            local.frames.append(frame)
+            local.names.append(self._get_frame_name(frame))
+        elif event == 'c_call':
+            local.frames.append(None)
+            local.names.append(getattr(arg, '__name__', 'builtin'))
+        elif event == 'return':
+            # Returns of frames not on the stack are ignored
+            for i in range(len(local.frames) - 1, -1, -1):
+                if local.frames[i] is frame:
+                    del local.frames[i:]
+                    del local.names[i:]
+                    break
+        elif local.frames and local.frames[-1] is None:
+            local.frames.pop()
+            local.names.pop()
+        local.last = time.time()
+
+
+    def enable(self):
+        # Start with the frames already running
+        frames = []
+        frame = sys._getframe(0)
+        while frame is not None:
+            frames.insert(0, frame)
+            frame = frame.f_back
+        self._local.frames = frames
+        self._local.names = [self._get_frame_name(frame) for frame in frames]
+        self._local.last = time.time()
+        threading.setprofile(self._profile)
+        sys.setprofile(self._profile)
+
+
+    def disable(self):
+        sys.setprofile(None)
+        threading.setprofile(None)
+
+
+    def dump_stats(self, file_name):
+        with open(file_name, 'w') as f:
+            for key, seconds in sorted(self.stacks.items()):
+                micro_seconds = int(seconds * 1000000)
+                if micro_seconds:
+                    f.write("%s %s\n" % (key, micro_seconds))
+
+
+class CloudStackProfiler(object):
+    """Profiler of a module run, the profile is written when the run exits.
+
+    Files are named <module>-<task>-<pid>.prof (pstats) or .folded
+    (collapsed), the task is CLOUDSTACK_PROFILE_TASK if set, else the start
+    time of the run.
+    """
+
+    # The profiler of this run
+    running = None
+
+    def __init__(self, profile_dir, profile_format='pstats'):
+        self.profile_dir = os.path.expanduser(profile_dir)
+        self.profile_format = profile_format
+        self.name = os.path.basename(sys.argv[0]).replace('.py', '') or 'module'
+        self.task = os.environ.get('CLOUDSTACK_PROFILE_TASK') or time.strftime('%Y%m%dT%H%M%S')
+        if profile_format == 'collapsed':
+            self.profiler = CloudStackStackProfiler()
+        else:
+            self.profiler = cProfile.Profile()
+
+
+    @classmethod
+    def start(cls, profile_dir, profile_format='pstats'):
+        """Start profiling the run unless already done, returns the profiler."""
+        if cls.running is None:
+            cls.running = cls(profile_dir, profile_format)
+            cls.running.profiler.enable()
+            atexit.register(cls.running.stop)
+        return cls.running
+
+
+    def get_file_name(self):
+        extension = 'folded' if self.profile_format == 'collapsed' else 'prof'
+        return os.path.join(self.profile_dir, "%s-%s-%s.%s" % (self.name, self.task, os.getpid(), extension))
+
+
+    def stop(self):
+        self.profiler.disable()
+        try:
+            if not os.path.isdir(self.profile_dir):
+                os.makedirs(self.profile_dir)
+            self.profiler.dump_stats(self.get_file_name())
+        except (IOError, OSError):
+            # Profiling never fails the run
+            pass
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import fcntl
+import os
+import time
+
+
+class CloudStackRateLimiter(object):
+    """Token bucket shared by all runs on the host through a locked state file.
+
+    Every call reserves a token, even if the bucket is empty, and sleeps until
+    its token is due. Bursts of up to one second worth of calls pass without
+    waiting.
+    """
+
+    def __init__(self, rate, state_file):
+        self.rate = float(rate)
+        self.burst = max(1.0, self.rate)
+        self.state_file = state_file
+
+
+    def acquire(self):
+        """Take a token, returns the seconds slept."""
+        # Never follow a link planted in place of the state file
+        fd = os.open(self.state_file, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            if os.fstat(fd).st_uid != os.geteuid():
+                raise OSError(errno.EPERM, "State file of the API rate limit not owned by the user", self.state_file)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = time.time()
+            try:
+                tokens, last = [float(v) for v in os.read(fd, 64).decode('ascii').split()]
+            except ValueError:
+                tokens, last = self.burst, now
+            tokens = min(self.burst, tokens + max(0, now - last) * self.rate) - 1
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, ("%f %f" % (tokens, now)).encode('ascii'))
+        finally:
+            # Closing releases the lock
+            os.close(fd)
+
+        sleep = max(0, -tokens / self.rate)
+        if sleep:
+            time.sleep(sleep)
+        return sleep
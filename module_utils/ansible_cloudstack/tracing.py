@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import json
+import os
+import random
+import threading
+import time
+
+
+class CloudStackSpan(object):
+    """Span of a trace, written when the with block is left.
+
+    Lazy spans are only written if they have child spans or failed.
+    """
+
+    def __init__(self, tracer, name, category, parent_id=None, args=None, lazy=False):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.parent_id = parent_id
+        self.args = args or {}
+        self.lazy = lazy
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.start = None
+
+
+    def __enter__(self):
+        stack = self.tracer.get_stack()
+        if self.parent_id is None and stack:
+            self.parent_id = stack[-1]
+        stack.append(self.span_id)
+        self.start = time.time()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.get_stack().pop()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        has_children = self.tracer.pop_parent(self.span_id)
+        if not self.lazy or has_children or exc_type is not None:
+            self.tracer.write_span(self)
+        return False
+
+
+class CloudStackTracer(object):
+    """Writes the spans of a module run to a file, a Chrome trace event per line.
+
+    Events are appended with a single write each, the runs of parallel forks
+    share the file. A span of the whole run is the root of the other spans,
+    spans have the ids of their parent in the args.
+    """
+
+    def __init__(self, trace_file, name):
+        self.trace_file = os.path.expanduser(trace_file)
+        self.pid = os.getpid()
+        self._local = threading.local()
+        # Ids of the spans a child span was written of
+        self._parents = set()
+        self._fd = None
+        try:
+            self._fd = os.open(self.trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        except OSError:
+            # Tracing never fails the run
+            return
+
+        # Shown as name of the process in trace viewers
+        self.write_event({
+            'name': 'process_name',
+            'ph': 'M',
+            'pid': self.pid,
+            'args': {'name': name},
+        })
+        self.root = CloudStackSpan(self, name, 'module')
+        self.root.__enter__()
+        atexit.register(self.close)
+
+
+    def get_stack(self):
+        """Return the ids of the spans entered in this thread."""
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+
+    def span(self, name, category, lazy=False, **args):
+        return CloudStackSpan(self, name, category, args=args, lazy=lazy)
+
+
+    def pop_parent(self, span_id):
+        """Return True if a child span of the span was written."""
+        if span_id in self._parents:
+            self._parents.discard(span_id)
+            return True
+        return False
+
+
+    def add_span(self, name, category, start, **args):
+        """Write a span started at start and ending now."""
+        span = CloudStackSpan(self, name, category, args=args)
+        stack = self.get_stack()
+        span.parent_id = stack[-1] if stack else None
+        span.start = start
+        self.write_span(span)
+
+
+    def wrap(self, func):
+        """Return func running in the span entered at the time of the call, for threads."""
+        stack = self.get_stack()
+        parent_id = stack[-1] if stack else None
+
+        def wrapped(*args, **kwargs):
+            thread_stack = self.get_stack()
+            thread_stack.append(parent_id)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                thread_stack.pop()
+        return wrapped
+
+
+    def write_span(self, span):
+        args = dict(span.args, span_id=span.span_id)
+        if span.parent_id is not None:
+            args['parent_id'] = span.parent_id
+            self._parents.add(span.parent_id)
+        self.write_event({
+            'name': span.name,
+            'cat': span.category,
+            'ph': 'X',
+            'ts': int(span.start * 1000000),
+            'dur': int((time.time() - span.start) * 1000000),
+            'pid': self.pid,
+            'tid': threading.current_thread().ident,
+            'args': args,
+        })
+
+
+    def write_event(self, event):
+        if self._fd is None:
+            return
+        try:
+            os.write(self._fd, (json.dumps(event, default=str) + '\n').encode('utf-8'))
+        except OSError:
+            pass
+
+
+    def close(self):
+        if self._fd is None:
+            return
+        self.root.__exit__(None, None, None)
+        os.close(self._fd)
+        self._fd = None
+
+
+class CloudStackTracedApi(object):
+    """Wraps the CloudStack client to trace a span per API call."""
+
+    def __init__(self, cs, tracer):
+        self._cs = cs
+        self._tracer = tracer
+
+
+    def __getattr__(self, name):
+        attr = getattr(self._cs, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(**args):
+            with self._tracer.span(name, 'api'):
+                return attr(**args)
+        return call
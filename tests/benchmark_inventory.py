@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Ansible,
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+######################################################################
+
+"""
+Benchmark of the inventory scripts.
+===================================
+
+Runs cloudstack.py and cloudstack-routers.py against synthetic fleets of
+VMs and routers and reports the wall time, the peak memory and the output
+size of --list, --list --stream and --host. The API is served in process by
+the cloudstack_simulator, so no network is involved. Every run happens in a
+subprocess to measure its peak memory on its own.
+
+The results can be saved with --output and compared to a saved baseline
+with --baseline, the exit code is 1 if a run got slower or bigger by more
+than --tolerance:
+
+  python benchmark_inventory.py --sizes 100,1000 --output baseline.json
+  python benchmark_inventory.py --sizes 100,1000 --baseline baseline.json
+
+
+usage: benchmark_inventory.py [--sizes SIZES] [--scripts SCRIPTS]
+                              [--modes MODES] [--output OUTPUT]
+                              [--baseline BASELINE] [--tolerance TOLERANCE]
+"""
+
+import argparse
+import imp
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.dirname(TESTS_DIR)
+
+sys.path.insert(0, TESTS_DIR)
+from cloudstack_simulator import CloudStackSimulator, parse_args as parse_simulator_args
+
+SCRIPTS = ['cloudstack.py', 'cloudstack-routers.py']
+MODES = ['list', 'stream', 'host']
+SIZES = [100, 1000, 10000, 50000]
+
+
+class CountingWriter(object):
+    """Stands in for stdout, counts the bytes written."""
+
+    def __init__(self):
+        self.size = 0
+
+
+    def write(self, value):
+        self.size += len(value)
+
+
+    def flush(self):
+        pass
+
+
+def get_peak_rss():
+    # Kilobytes on Linux, bytes on OS X
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss = peak_rss // 1024
+    return peak_rss
+
+
+def install_fake_cs(simulator, calls):
+    """Install a cs module whose client asks the simulator in process."""
+    cs = types.ModuleType('cs')
+
+    class CloudStackException(Exception):
+        pass
+
+    class CloudStack(object):
+        def __init__(self, endpoint, key, secret, **kwargs):
+            self.endpoint = endpoint
+
+        def __getattr__(self, command):
+            if command.startswith('_'):
+                raise AttributeError(command)
+
+            def call(**args):
+                calls.append(command)
+                args = dict((key, str(value)) for key, value in args.items())
+                # Serialize the response like the API and the client would
+                return json.loads(json.dumps(simulator.call(command, args)))
+            return call
+
+    def read_config(ini_group=None):
+        return dict(endpoint='http://simulator/client/api', key='key', secret='secret')
+
+    cs.CloudStack = CloudStack
+    cs.CloudStackException = CloudStackException
+    cs.read_config = read_config
+    sys.modules['cs'] = cs
+
+
+def get_script_args(script, size, mode):
+    if mode == 'host':
+        if script == 'cloudstack.py':
+            # Seeded VMs are named 'VM <i>'
+            return ['--host', 'VM %s' % (size // 2)]
+        return ['--host', 'r-%s-VM' % (size // 2 + 1)]
+    if mode == 'stream':
+        return ['--list', '--stream']
+    return ['--list']
+
+
+def run_child(script, size, mode):
+    """Run one inventory in this process and print its numbers as JSON."""
+    vms, routers = (size, 0) if script == 'cloudstack.py' else (0, size)
+    options = parse_simulator_args([
+        '--vms', str(vms),
+        '--routers', str(routers),
+        '--projects', '0',
+        '--job-delay', '0',
+        '--seed', '1',
+    ])
+    simulator = CloudStackSimulator(options)
+    calls = []
+    install_fake_cs(simulator, calls)
+
+    # Neither cache nor index, every run hits the API
+    config_dir = tempfile.mkdtemp()
+    config_file = os.path.join(config_dir, 'cloudstack.ini')
+    with open(config_file, 'w') as f:
+        f.write("[inventory]\ncache_max_age = 0\n")
+    os.environ['CLOUDSTACK_CONFIG'] = config_file
+    os.chdir(config_dir)
+
+    baseline_rss = get_peak_rss()
+    sys.argv = [script] + get_script_args(script, size, mode)
+    out = CountingWriter()
+    sys.stdout = out
+    start = time.time()
+    try:
+        inventory = imp.load_source('inventory', os.path.join(SCRIPTS_DIR, script))
+        # cloudstack-routers.py runs cloudstack.py in main()
+        if hasattr(inventory, 'main'):
+            inventory.main()
+        else:
+            inventory.CloudStackInventory()
+    finally:
+        sys.stdout = sys.__stdout__
+    seconds = time.time() - start
+    os.remove(config_file)
+    os.rmdir(config_dir)
+
+    peak_rss = get_peak_rss()
+    print(json.dumps({
+        'script': script,
+        'size': size,
+        'mode': mode,
+        'seconds': round(seconds, 3),
+        'peak_rss_kb': peak_rss,
+        'run_rss_kb': peak_rss - baseline_rss,
+        'output_bytes': out.size,
+        'api_calls': len(calls),
+    }))
+
+
+def run(script, size, mode):
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__),
+        '--child', script, str(size), mode,
+    ])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def compare(results, baseline, tolerance):
+    """Return the runs slower or bigger than in the baseline."""
+    regressions = []
+    baseline = dict(((r['script'], r['size'], r['mode']), r) for r in baseline)
+    for result in results:
+        before = baseline.get((result['script'], result['size'], result['mode']))
+        if not before:
+            continue
+        for key in ['seconds', 'run_rss_kb', 'output_bytes']:
+            # Ignore the noise of tiny numbers
+            if result[key] > before[key] * (1 + tolerance) and result[key] - before[key] > {'seconds': 0.05, 'run_rss_kb': 1024, 'output_bytes': 0}[key]:
+                regressions.append("%s %s %s: %s %s -> %s" % (result['script'], result['size'], result['mode'], key, before[key], result[key]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the inventory scripts.')
+    parser.add_argument('--sizes', default=','.join(str(s) for s in SIZES),
+                        help='comma separated numbers of hosts')
+    parser.add_argument('--scripts', default=','.join(SCRIPTS),
+                        help='comma separated inventory scripts')
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help='comma separated modes: %s' % ', '.join(MODES))
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results to this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='share a run may be slower or bigger than in the baseline')
+    parser.add_argument('--child', nargs=3, metavar=('SCRIPT', 'SIZE', 'MODE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child[0], int(args.child[1]), args.child[2])
+        return
+
+    results = []
+    print("%-22s %8s %7s %9s %12s %12s %9s" % ('script', 'hosts', 'mode', 'seconds', 'run_rss_mb', 'output_kb', 'calls'))
+    for script in args.scripts.split(','):
+        for size in [int(s) for s in args.sizes.split(',')]:
+            for mode in args.modes.split(','):
+                result = run(script, size, mode)
+                results.append(result)
+                print("%-22s %8s %7s %9.3f %12.1f %12.1f %9s" % (
+                    script, size, mode, result['seconds'], result['run_rss_kb'] / 1024.0,
+                    result['output_bytes'] / 1024.0, result['api_calls']))
+                sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("Regression: %s" % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,824 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Ansible,
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+######################################################################
+
+"""
+Local CloudStack API simulator.
+===============================
+
+Speaks the subset of the CloudStack API used by the cs_* modules and the
+inventory scripts, backed by an in-memory synthetic cloud. It is meant to
+benchmark and regression test the modules offline, it does neither verify
+signatures nor permissions.
+
+Point 'cloudstack.ini' (or the api_* module arguments) to it:
+
+  [cloudstack]
+  endpoint = http://localhost:8888/client/api
+  key = any
+  secret = any
+
+
+Async jobs finish after --job-delay seconds. Faults can be injected:
+--latency adds a delay to every request, --error-rate answers a share of
+the requests with an internal error (530) and --throttle-rate with an
+api.throttling error (429). With --seed the ids and the injected faults are
+the same every run. Like the setting default.page.size, --max-page-size
+rejects lists asking for larger pages.
+
+
+usage: cloudstack_simulator.py [--port PORT] [--vms VMS] [--networks NETWORKS]
+                               [--projects PROJECTS] [--routers ROUTERS]
+                               [--templates TEMPLATES] [--job-delay SECONDS]
+                               [--latency SECONDS] [--error-rate RATE]
+                               [--throttle-rate RATE] [--seed SEED]
+                               [--max-page-size SIZE]
+"""
+
+import argparse
+import calendar
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, urlparse
+
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S+0000'
+
+HYPERVISORS = ['KVM', 'VMware', 'XenServer']
+
+# list command: (response key, resource type, keys matched by the keyword)
+LIST_COMMANDS = {
+    'listZones':                     ('zone', 'zones', ['name']),
+    'listDomains':                   ('domain', 'domains', ['name']),
+    'listAccounts':                  ('account', 'accounts', ['name']),
+    'listProjects':                  ('project', 'projects', ['name', 'displaytext']),
+    'listServiceOfferings':          ('serviceoffering', 'serviceofferings', ['name']),
+    'listDiskOfferings':             ('diskoffering', 'diskofferings', ['name']),
+    'listTemplates':                 ('template', 'templates', ['name']),
+    'listIsos':                      ('iso', 'isos', ['name']),
+    'listOsTypes':                   ('ostype', 'ostypes', ['description']),
+    'listNetworks':                  ('network', 'networks', ['name']),
+    'listVPCs':                      ('vpc', 'vpcs', ['name', 'displaytext']),
+    'listVirtualMachines':           ('virtualmachine', 'vms', ['name', 'displayname', 'state']),
+    'listRouters':                   ('router', 'routers', ['name']),
+    'listSystemVms':                 ('systemvm', 'systemvms', ['name']),
+    'listInstanceGroups':            ('instancegroup', 'instancegroups', ['name']),
+    'listPublicIpAddresses':         ('publicipaddress', 'publicipaddresses', ['ipaddress']),
+    'listFirewallRules':             ('firewallrule', 'firewallrules', []),
+    'listPortForwardingRules':       ('portforwardingrule', 'portforwardingrules', []),
+    'listLoadBalancerRules':         ('loadbalancerrule', 'loadbalancerrules', ['name']),
+    'listSecurityGroups':            ('securitygroup', 'securitygroups', ['name']),
+    'listTags':                      ('tag', 'tags', ['key', 'value']),
+    'listAsyncJobs':                 ('asyncjobs', 'jobs', []),
+    'listEvents':                    ('event', 'events', ['description']),
+}
+
+# Filter args of list commands matching the resource key of the same name
+FILTER_ARGS = [
+    'id', 'zoneid', 'domainid', 'account', 'state', 'vpcid', 'ipaddress',
+    'networkid', 'virtualmachineid', 'ostypeid', 'role', 'systemvmtype',
+    'resourcetype', 'resourceid', 'type', 'level', 'groupid',
+]
+
+# Resource types of the tags API: resource type
+TAGGABLE_RESOURCES = {
+    'UserVm':           'vms',
+    'Network':          'networks',
+    'Vpc':              'vpcs',
+    'Template':         'templates',
+    'ISO':              'isos',
+    'FirewallRule':     'firewallrules',
+    'PortForwardingRule': 'portforwardingrules',
+    'LoadBalancer':     'loadbalancerrules',
+    'SecurityGroup':    'securitygroups',
+    'Project':          'projects',
+}
+
+
+class CloudStackError(Exception):
+    def __init__(self, errortext, errorcode=431):
+        super(CloudStackError, self).__init__(errortext)
+        self.errortext = errortext
+        self.errorcode = errorcode
+
+
+def now():
+    return time.strftime(DATE_FORMAT, time.gmtime())
+
+
+def parse_startdate(command, value):
+    """Return the start date of a list in DATE_FORMAT, in the format its API takes.
+
+    Like CloudStack, listAsyncJobs takes ISO 8601 dates with the offset
+    (2016-10-16T10:26:05+0200), listEvents dates in the time of the server.
+    """
+    if command == 'listAsyncJobs':
+        match = re.match(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)([+-])(\d\d)(\d\d)$', value)
+    else:
+        match = re.match(r'^(\d{4}-\d\d-\d\d(?: \d\d:\d\d:\d\d)?)$', value)
+    if not match:
+        raise CloudStackError("Unable to parse date %s for command %s, please pass dates in the format mentioned in the api documentation" % (value, command.lower()))
+    date = match.group(1).replace('T', ' ')
+    if len(date) == 10:
+        date += ' 00:00:00'
+    timestamp = calendar.timegm(time.strptime(date, '%Y-%m-%d %H:%M:%S'))
+    if match.lastindex > 1:
+        offset = int(match.group(3)) * 3600 + int(match.group(4)) * 60
+        timestamp -= offset if match.group(2) == '+' else -offset
+    return time.strftime(DATE_FORMAT, time.gmtime(timestamp))
+
+
+def unflatten(args):
+    """Turn args like tags[0].key=a and tags[0].value=b into lists of dicts."""
+    result = {}
+    lists = {}
+    for key, value in args.items():
+        match = re.match(r'^(\w+)\[(\d+)\]\.(\w+)$', key)
+        if match:
+            name, index, field = match.group(1), int(match.group(2)), match.group(3)
+            lists.setdefault(name, {}).setdefault(index, {})[field] = value
+        else:
+            result[key] = value
+    for name, items in lists.items():
+        result[name] = [items[i] for i in sorted(items)]
+    return result
+
+
+class CloudStackSimulator(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.random = random.Random(options.seed)
+        self.data = dict((resource_type, []) for (key, resource_type, keywords) in LIST_COMMANDS.values())
+        self.seed()
+
+
+    def new_id(self):
+        # Drawn from the seeded generator, a seed gives the same ids every run
+        return str(uuid.UUID(int=self.random.getrandbits(128), version=4))
+
+
+    def seed(self):
+        """Create a synthetic cloud of the configured size."""
+        zone = self.add('zones', {'id': self.new_id(), 'name': 'ZUERICH', 'networktype': 'Advanced', 'allocationstate': 'Enabled'})
+        domain = self.add('domains', {'id': self.new_id(), 'name': 'ROOT', 'path': 'ROOT', 'level': 0})
+        account = self.add('accounts', {'id': self.new_id(), 'name': 'admin', 'domain': 'ROOT', 'domainid': domain['id'], 'accounttype': 1, 'state': 'enabled'})
+        self.zone, self.domain, self.account = zone, domain, account
+
+        for name, cpu, memory in [('Small', 1, 1024), ('Medium', 2, 4096), ('Large', 4, 8192)]:
+            self.add('serviceofferings', {'id': self.new_id(), 'name': name, 'displaytext': name, 'cpunumber': cpu, 'cpuspeed': 2000, 'memory': memory})
+        for size in [10, 20, 100]:
+            self.add('diskofferings', {'id': self.new_id(), 'name': '%sGB' % size, 'displaytext': '%s GB disk' % size, 'disksize': size})
+        for description in ['Debian GNU/Linux 8 (64-bit)', 'CentOS 7', 'Ubuntu 16.04 (64-bit)', 'Other (64-bit)']:
+            self.add('ostypes', {'id': self.new_id(), 'description': description})
+
+        for i in range(self.options.projects):
+            self.add('projects', {
+                'id': self.new_id(),
+                'name': 'project-%s' % i,
+                'displaytext': 'Project %s' % i,
+                'account': account['name'],
+                'domain': domain['name'],
+                'domainid': domain['id'],
+                'state': 'Active',
+            })
+
+        for i in range(self.options.templates):
+            self.add('templates', {
+                'id': self.new_id(),
+                'name': 'template-%s' % i,
+                'displaytext': 'Linux Template %s 64-bit' % i,
+                'hypervisor': HYPERVISORS[i % len(HYPERVISORS)],
+                'ostypeid': self.data['ostypes'][i % len(self.data['ostypes'])]['id'],
+                'zoneid': zone['id'],
+                'zonename': zone['name'],
+                'isready': True,
+                'templatetype': 'USER',
+                'tags': [],
+            })
+
+        for i in range(self.options.networks):
+            self.create_network({
+                'name': 'network-%s' % i,
+                'displaytext': 'Network %s' % i,
+                'zoneid': zone['id'],
+                'projectid': self.get_project_id(i),
+            })
+
+        for i in range(self.options.vms):
+            self.create_vm({
+                'name': 'vm-%s' % i,
+                'displayname': 'VM %s' % i,
+                'zoneid': zone['id'],
+                'group': 'group-%s' % (i % 10),
+                'projectid': self.get_project_id(i),
+                'serviceofferingid': self.data['serviceofferings'][i % 3]['id'],
+                'templateid': self.data['templates'][i % len(self.data['templates'])]['id'] if self.data['templates'] else None,
+                'networkids': self.data['networks'][i % len(self.data['networks'])]['id'] if self.data['networks'] else None,
+            })
+
+        for i in range(self.options.routers):
+            project = self.get_project(self.get_project_id(i))
+            self.add('routers', dict(self.get_owner(project), **{
+                'id': self.new_id(),
+                'name': 'r-%s-VM' % (i + 1),
+                'zoneid': zone['id'],
+                'zonename': zone['name'],
+                'state': 'Running' if i % 20 else 'Stopped',
+                'redundantstate': ['MASTER', 'BACKUP', 'UNKNOWN'][i % 3],
+                'role': 'VIRTUAL_ROUTER',
+                'linklocalip': '169.254.%s.%s' % (i // 250 % 250, i % 250 + 1),
+                'networkdomain': 'cs%s.cloud.internal' % i,
+                'serviceofferingname': 'System Offering For Software Router',
+                'nic': [self.get_nic(i, isdefault=True)],
+            }))
+
+        for i, systemvmtype in enumerate(['consoleproxy', 'secondarystoragevm']):
+            self.add('systemvms', {
+                'id': self.new_id(),
+                'name': '%s-%s-VM' % (systemvmtype[0], i + 1),
+                'systemvmtype': systemvmtype,
+                'zoneid': zone['id'],
+                'zonename': zone['name'],
+                'state': 'Running',
+                'linklocalip': '169.254.255.%s' % (i + 1),
+                'privateip': '10.0.255.%s' % (i + 1),
+                'publicip': '192.0.2.%s' % (i + 1),
+                'created': now(),
+            })
+
+
+    def get_project_id(self, i):
+        # Every second resource belongs to a project, if there are any
+        projects = self.data['projects']
+        if not projects or i % 2:
+            return None
+        return projects[i // 2 % len(projects)]['id']
+
+
+    def get_project(self, project_id):
+        if not project_id:
+            return None
+        for project in self.data['projects']:
+            if project['id'] == project_id:
+                return project
+        raise CloudStackError("Unable to find project by id %s" % project_id)
+
+
+    def get_owner(self, project=None):
+        owner = {
+            'account': self.account['name'],
+            'domain': self.domain['name'],
+            'domainid': self.domain['id'],
+        }
+        if project:
+            owner = {
+                'project': project['name'],
+                'projectid': project['id'],
+                'domain': self.domain['name'],
+                'domainid': self.domain['id'],
+            }
+        return owner
+
+
+    def get_nic(self, i, isdefault=False, network=None):
+        return {
+            'id': self.new_id(),
+            'networkid': network['id'] if network else self.new_id(),
+            'networkname': network['name'] if network else 'guest',
+            'ipaddress': '10.%s.%s.%s' % (i // 62500 % 250, i // 250 % 250, i % 250 + 2),
+            'macaddress': '02:00:%02x:%02x:%02x:01' % (i // 65536 % 256, i // 256 % 256, i % 256),
+            'netmask': '255.255.255.0',
+            'gateway': '10.%s.%s.1' % (i // 62500 % 250, i // 250 % 250),
+            'type': 'Isolated',
+            'traffictype': 'Guest',
+            'isdefault': isdefault,
+            'secondaryip': [],
+        }
+
+
+    def add(self, resource_type, resource):
+        # The API omits unset keys rather than returning null
+        resource = dict((k, v) for k, v in resource.items() if v is not None)
+        self.data[resource_type].append(resource)
+        return resource
+
+
+    def find(self, resource_type, resource_id):
+        for resource in self.data[resource_type]:
+            if resource['id'] == resource_id:
+                return resource
+        raise CloudStackError("Unable to execute API command due to invalid value. Invalid parameter id value=%s due to incorrect long value format, or entity does not exist" % resource_id)
+
+
+    def add_event(self, event_type, description, resource=None, resourcetype=None):
+        self.add('events', {
+            'id': self.new_id(),
+            'type': event_type,
+            'level': 'INFO',
+            'state': 'Completed',
+            'description': description,
+            'resourceid': resource['id'] if resource else None,
+            'resourcetype': resourcetype,
+            'account': self.account['name'],
+            'domain': self.domain['name'],
+            'domainid': self.domain['id'],
+            'created': now(),
+        })
+
+
+    def add_job(self, cmd, result_key=None, resource=None, instancetype=None):
+        job = {
+            'jobid': self.new_id(),
+            'cmd': cmd,
+            'created': now(),
+            'jobstatus': 0,
+            'jobresultcode': 0,
+            'jobresulttype': 'object',
+            'jobinstancetype': instancetype,
+            'jobinstanceid': resource['id'] if resource else None,
+            'accountid': self.account['id'],
+            'userid': self.account['id'],
+            'ready': time.time() + self.options.job_delay,
+            'result': {result_key: resource} if result_key else {'success': True},
+        }
+        self.add('jobs', job)
+        response = {'jobid': job['jobid']}
+        if resource:
+            response['id'] = resource['id']
+        return response
+
+
+    def get_job(self, job):
+        job = dict(job)
+        ready = job.pop('ready')
+        result = job.pop('result')
+        if time.time() >= ready:
+            job['jobstatus'] = 1
+            job['jobresult'] = result
+        return job
+
+
+    def create_network(self, args):
+        project = self.get_project(args.get('projectid'))
+        network = dict(self.get_owner(project), **{
+            'id': self.new_id(),
+            'name': args['name'],
+            'displaytext': args.get('displaytext') or args['name'],
+            'zoneid': args.get('zoneid') or self.zone['id'],
+            'zonename': self.zone['name'],
+            'state': 'Implemented',
+            'type': 'Isolated',
+            'traffictype': 'Guest',
+            'cidr': '10.1.1.0/24',
+            'tags': [],
+        })
+        if args.get('vpcid'):
+            network['vpcid'] = args['vpcid']
+        return self.add('networks', network)
+
+
+    def create_vm(self, args):
+        project = self.get_project(args.get('projectid'))
+        i = len(self.data['vms'])
+        offering = self.find('serviceofferings', args['serviceofferingid']) if args.get('serviceofferingid') else self.data['serviceofferings'][0]
+        template = self.find('templates', args['templateid']) if args.get('templateid') else None
+        networks = [self.find('networks', network_id) for network_id in (args.get('networkids') or '').split(',') if network_id]
+        name = args.get('name') or 'VM-%s' % self.new_id()
+        vm = dict(self.get_owner(project), **{
+            'id': self.new_id(),
+            'name': name,
+            'displayname': args.get('displayname') or name,
+            'instancename': 'i-2-%s-VM' % (i + 1),
+            'zoneid': self.zone['id'],
+            'zonename': self.zone['name'],
+            'state': 'Running' if str(args.get('startvm', 'true')).lower() == 'true' else 'Stopped',
+            'serviceofferingid': offering['id'],
+            'serviceofferingname': offering['name'],
+            'cpunumber': offering['cpunumber'],
+            'cpuspeed': offering['cpuspeed'],
+            'memory': offering['memory'],
+            'cpuused': '%s%%' % (i % 100),
+            'templateid': template['id'] if template else None,
+            'templatename': template['name'] if template else None,
+            'hypervisor': template['hypervisor'] if template else HYPERVISORS[i % len(HYPERVISORS)],
+            'passwordenabled': False,
+            'keypair': args.get('keypair'),
+            'affinitygroup': [],
+            'securitygroup': [],
+            'tags': [],
+            'created': now(),
+            'nic': [self.get_nic(i, isdefault=(n == 0), network=network) for n, network in enumerate(networks or [None])],
+        })
+        if args.get('group'):
+            vm['group'] = args['group']
+            if not [g for g in self.data['instancegroups'] if g['name'] == args['group']]:
+                self.add('instancegroups', dict(self.get_owner(project), id=self.new_id(), name=args['group'], created=now()))
+        vm = self.add('vms', vm)
+        self.add_event('VM.CREATE', 'Successfully completed deploying Vm. Vm Id: %s' % vm['id'], vm, 'VirtualMachine')
+        return vm
+
+
+    # Commands
+
+    def list_resources(self, command, args):
+        key, resource_type, keyword_keys = LIST_COMMANDS[command]
+        resources = self.data[resource_type]
+
+        # Resources of projects are only listed if asked for, -1 lists all of them
+        projectid = args.get('projectid')
+        if resource_type not in ['projects', 'zones', 'domains', 'accounts', 'serviceofferings', 'diskofferings', 'ostypes', 'templates', 'isos', 'systemvms', 'jobs', 'events']:
+            if projectid == '-1':
+                resources = [r for r in resources if r.get('projectid')]
+            elif projectid:
+                resources = [r for r in resources if r.get('projectid') == projectid]
+            else:
+                resources = [r for r in resources if not r.get('projectid')]
+
+        for arg in FILTER_ARGS:
+            if args.get(arg):
+                resources = [r for r in resources if str(r.get(arg)) == args[arg]]
+
+        if args.get('ids'):
+            ids = args['ids'].split(',')
+            resources = [r for r in resources if r.get('id') in ids]
+
+        if args.get('name'):
+            resources = [r for r in resources if r.get('name', '').lower() == args['name'].lower()]
+
+        if args.get('keyword'):
+            keyword = args['keyword'].lower()
+            resources = [r for r in resources if [k for k in keyword_keys if keyword in str(r.get(k, '')).lower()]]
+
+        if args.get('startdate') and resource_type in ['jobs', 'events']:
+            startdate = parse_startdate(command, args['startdate'])
+            resources = [r for r in resources if r['created'] >= startdate]
+
+        # Like CloudStack, newest first
+        if resource_type in ['jobs', 'events']:
+            resources = list(reversed(resources))
+
+        if resource_type == 'jobs':
+            resources = [self.get_job(job) for job in resources]
+
+        count = len(resources)
+        if args.get('page') or args.get('pagesize'):
+            pagesize = int(args.get('pagesize', self.options.max_page_size))
+            if pagesize > self.options.max_page_size:
+                raise CloudStackError("Page size can't exceed max allowed page size value: %s" % self.options.max_page_size)
+            page = int(args.get('page', 1))
+            resources = resources[(page - 1) * pagesize:page * pagesize]
+
+        if not resources:
+            return {}
+        return {'count': count, key: resources}
+
+
+    def cmd_listHypervisors(self, args):
+        return {'count': len(HYPERVISORS), 'hypervisor': [{'name': h} for h in HYPERVISORS]}
+
+
+    def cmd_listCapabilities(self, args):
+        return {'capability': {
+            'cloudstackversion': '4.9.0',
+            'securitygroupsenabled': False,
+            'userpublictemplateenabled': True,
+            'supportELB': 'false',
+            'projectinviterequired': False,
+            'allowusercreateprojects': True,
+            'kvmsnapshotenabled': False,
+            'apilimitinterval': 1,
+            'apilimitmax': 100,
+        }}
+
+
+    def cmd_listNics(self, args):
+        vm = self.find('vms', args.get('virtualmachineid'))
+        return {'count': len(vm['nic']), 'nic': vm['nic']}
+
+
+    def cmd_listLoadBalancerRuleInstances(self, args):
+        rule = self.find('loadbalancerrules', args.get('id'))
+        vms = [self.find('vms', vm_id) for vm_id in rule['members']]
+        if not vms:
+            return {}
+        return {'count': len(vms), 'loadbalancerruleinstance': vms}
+
+
+    def cmd_queryAsyncJobResult(self, args):
+        for job in self.data['jobs']:
+            if job['jobid'] == args.get('jobid'):
+                return self.get_job(job)
+        raise CloudStackError("Unable to find job by id %s" % args.get('jobid'))
+
+
+    def cmd_deployVirtualMachine(self, args):
+        vm = self.create_vm(args)
+        return self.add_job('org.apache.cloudstack.api.command.user.vm.DeployVMCmd', 'virtualmachine', vm, 'VirtualMachine')
+
+
+    def _vm_action(self, args, state, event_type, cmd):
+        vm = self.find('vms', args.get('id'))
+        vm['state'] = state
+        self.add_event(event_type, '%s Vm. Vm Id: %s' % (event_type, vm['id']), vm, 'VirtualMachine')
+        return self.add_job(cmd, 'virtualmachine', vm, 'VirtualMachine')
+
+
+    def cmd_startVirtualMachine(self, args):
+        return self._vm_action(args, 'Running', 'VM.START', 'org.apache.cloudstack.api.command.user.vm.StartVMCmd')
+
+
+    def cmd_stopVirtualMachine(self, args):
+        return self._vm_action(args, 'Stopped', 'VM.STOP', 'org.apache.cloudstack.api.command.user.vm.StopVMCmd')
+
+
+    def cmd_rebootVirtualMachine(self, args):
+        return self._vm_action(args, 'Running', 'VM.REBOOT', 'org.apache.cloudstack.api.command.user.vm.RebootVMCmd')
+
+
+    def cmd_destroyVirtualMachine(self, args):
+        vm = self.find('vms', args.get('id'))
+        if str(args.get('expunge')).lower() == 'true':
+            self.data['vms'].remove(vm)
+            vm['state'] = 'Expunging'
+        else:
+            vm['state'] = 'Destroyed'
+        self.add_event('VM.DESTROY', 'Successfully completed destroying Vm. Vm Id: %s' % vm['id'], vm, 'VirtualMachine')
+        return self.add_job('org.apache.cloudstack.api.command.user.vm.DestroyVMCmd', 'virtualmachine', vm, 'VirtualMachine')
+
+
+    def cmd_createProject(self, args):
+        project = self.add('projects', dict(self.get_owner(), **{
+            'id': self.new_id(),
+            'name': args['name'],
+            'displaytext': args.get('displaytext') or args['name'],
+            'state': 'Active',
+            'tags': [],
+        }))
+        self.add_event('PROJECT.CREATE', 'Creating project %s' % project['name'], project, 'Project')
+        return self.add_job('org.apache.cloudstack.api.command.user.project.CreateProjectCmd', 'project', project, 'Project')
+
+
+    def cmd_deleteProject(self, args):
+        project = self.find('projects', args.get('id'))
+        self.data['projects'].remove(project)
+        self.add_event('PROJECT.DELETE', 'Deleting project %s' % project['name'], project, 'Project')
+        return self.add_job('org.apache.cloudstack.api.command.user.project.DeleteProjectCmd', instancetype='Project')
+
+
+    def cmd_createNetwork(self, args):
+        return {'network': self.create_network(args)}
+
+
+    def cmd_deleteNetwork(self, args):
+        network = self.find('networks', args.get('id'))
+        self.data['networks'].remove(network)
+        return self.add_job('org.apache.cloudstack.api.command.user.network.DeleteNetworkCmd', instancetype='Network')
+
+
+    def _create_rule(self, resource_type, result_key, args, cmd):
+        ip_address = None
+        if args.get('ipaddressid'):
+            ip_address = self.find('publicipaddresses', args['ipaddressid'])
+        rule = {
+            'id': self.new_id(),
+            'protocol': args.get('protocol', 'tcp'),
+            'startport': args.get('startport'),
+            'endport': args.get('endport'),
+            'publicport': args.get('publicport'),
+            'privateport': args.get('privateport'),
+            'ipaddressid': args.get('ipaddressid'),
+            'ipaddress': ip_address['ipaddress'] if ip_address else None,
+            'cidrlist': args.get('cidrlist', '0.0.0.0/0'),
+            'virtualmachineid': args.get('virtualmachineid'),
+            'name': args.get('name'),
+            'algorithm': args.get('algorithm'),
+            'state': 'Active',
+            'members': [],
+            'tags': [],
+        }
+        rule = self.add(resource_type, rule)
+        return self.add_job(cmd, result_key, rule, 'FirewallRule')
+
+
+    def _delete_rule(self, resource_type, args, cmd):
+        rule = self.find(resource_type, args.get('id'))
+        self.data[resource_type].remove(rule)
+        return self.add_job(cmd, instancetype='FirewallRule')
+
+
+    def cmd_createFirewallRule(self, args):
+        return self._create_rule('firewallrules', 'firewallrule', args, 'org.apache.cloudstack.api.command.user.firewall.CreateFirewallRuleCmd')
+
+
+    def cmd_deleteFirewallRule(self, args):
+        return self._delete_rule('firewallrules', args, 'org.apache.cloudstack.api.command.user.firewall.DeleteFirewallRuleCmd')
+
+
+    def cmd_createPortForwardingRule(self, args):
+        return self._create_rule('portforwardingrules', 'portforwardingrule', args, 'org.apache.cloudstack.api.command.user.firewall.CreatePortForwardingRuleCmd')
+
+
+    def cmd_deletePortForwardingRule(self, args):
+        return self._delete_rule('portforwardingrules', args, 'org.apache.cloudstack.api.command.user.firewall.DeletePortForwardingRuleCmd')
+
+
+    def cmd_createLoadBalancerRule(self, args):
+        return self._create_rule('loadbalancerrules', 'loadbalancer', args, 'org.apache.cloudstack.api.command.user.loadbalancer.CreateLoadBalancerRuleCmd')
+
+
+    def cmd_deleteLoadBalancerRule(self, args):
+        return self._delete_rule('loadbalancerrules', args, 'org.apache.cloudstack.api.command.user.loadbalancer.DeleteLoadBalancerRuleCmd')
+
+
+    def cmd_assignToLoadBalancerRule(self, args):
+        rule = self.find('loadbalancerrules', args.get('id'))
+        for vm_id in args.get('virtualmachineids', '').split(','):
+            if vm_id not in rule['members']:
+                rule['members'].append(self.find('vms', vm_id)['id'])
+        return self.add_job('org.apache.cloudstack.api.command.user.loadbalancer.AssignToLoadBalancerRuleCmd', instancetype='FirewallRule')
+
+
+    def cmd_removeFromLoadBalancerRule(self, args):
+        rule = self.find('loadbalancerrules', args.get('id'))
+        for vm_id in args.get('virtualmachineids', '').split(','):
+            if vm_id in rule['members']:
+                rule['members'].remove(vm_id)
+        return self.add_job('org.apache.cloudstack.api.command.user.loadbalancer.RemoveFromLoadBalancerRuleCmd', instancetype='FirewallRule')
+
+
+    def cmd_registerTemplate(self, args):
+        template = self.add('templates', {
+            'id': self.new_id(),
+            'name': args['name'],
+            'displaytext': args.get('displaytext') or args['name'],
+            'hypervisor': args.get('hypervisor', 'KVM'),
+            'ostypeid': args.get('ostypeid'),
+            'zoneid': self.zone['id'],
+            'zonename': self.zone['name'],
+            'isready': True,
+            'templatetype': 'USER',
+            'tags': [],
+        })
+        return {'count': 1, 'template': [template]}
+
+
+    def cmd_deleteTemplate(self, args):
+        template = self.find('templates', args.get('id'))
+        self.data['templates'].remove(template)
+        return self.add_job('org.apache.cloudstack.api.command.user.template.DeleteTemplateCmd', instancetype='Template')
+
+
+    def _get_tagged_resources(self, args):
+        resource_type = TAGGABLE_RESOURCES.get(args.get('resourcetype'))
+        if not resource_type:
+            raise CloudStackError("Unsupported resource type %s" % args.get('resourcetype'))
+        return [self.find(resource_type, resource_id) for resource_id in args.get('resourceids', '').split(',')]
+
+
+    def cmd_createTags(self, args):
+        for resource in self._get_tagged_resources(args):
+            for tag in args.get('tags', []):
+                if [t for t in resource['tags'] if t['key'] == tag['key']]:
+                    raise CloudStackError("tag %s already on UserVm with id %s" % (tag['key'], resource['id']), 530)
+                tag = dict(tag, resourceid=resource['id'], resourcetype=args['resourcetype'])
+                resource['tags'].append(tag)
+                self.add('tags', tag)
+        return self.add_job('org.apache.cloudstack.api.command.user.tag.CreateTagsCmd', instancetype=args.get('resourcetype'))
+
+
+    def cmd_deleteTags(self, args):
+        for resource in self._get_tagged_resources(args):
+            for tag in args.get('tags', []):
+                for t in resource['tags'][:]:
+                    if t['key'] == tag['key'] and t.get('value') in [None, tag.get('value')]:
+                        resource['tags'].remove(t)
+                        self.data['tags'].remove(t)
+        return self.add_job('org.apache.cloudstack.api.command.user.tag.DeleteTagsCmd', instancetype=args.get('resourcetype'))
+
+
+    def call(self, command, args):
+        args = unflatten(args)
+        with self.lock:
+            if command in LIST_COMMANDS:
+                return self.list_resources(command, args)
+            handler = getattr(self, 'cmd_%s' % command, None)
+            if handler is None:
+                raise CloudStackError("The given command does not exist or it is not available for user", 432)
+            return handler(args)
+
+
+class CloudStackSimulatorHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_api(dict(parse_qsl(urlparse(self.path).query)))
+
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        self.handle_api(dict(parse_qsl(body)))
+
+
+    def handle_api(self, args):
+        simulator = self.server.simulator
+        options = simulator.options
+        command = args.pop('command', '')
+        for key in ['apiKey', 'apikey', 'signature', 'signatureVersion', 'expires', 'response']:
+            args.pop(key, None)
+
+        if options.latency:
+            time.sleep(options.latency * simulator.random.uniform(0.5, 1.5))
+
+        status = 200
+        try:
+            if options.throttle_rate and simulator.random.random() < options.throttle_rate:
+                raise CloudStackError("There are too many API calls. Please try again later. (api.throttling)", 429)
+            if options.error_rate and simulator.random.random() < options.error_rate:
+                raise CloudStackError("Internal error executing command, please contact your system administrator", 530)
+            data = simulator.call(command, args)
+        except CloudStackError as e:
+            status = e.errorcode
+            data = {'uuidList': [], 'errorcode': e.errorcode, 'cserrorcode': 9999, 'errortext': e.errortext}
+
+        body = json.dumps({'%sresponse' % command.lower(): data}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        if self.server.simulator.options.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class CloudStackSimulatorServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Local CloudStack API simulator.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--vms', type=int, default=100, help='number of VMs to seed')
+    parser.add_argument('--networks', type=int, default=10, help='number of networks to seed')
+    parser.add_argument('--projects', type=int, default=2, help='number of projects to seed')
+    parser.add_argument('--routers', type=int, default=10, help='number of routers to seed')
+    parser.add_argument('--templates', type=int, default=5, help='number of templates to seed')
+    parser.add_argument('--job-delay', type=float, default=1.0, help='seconds until an async job finishes')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests failing with an internal error')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests failing with api.throttling')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the random generator')
+    parser.add_argument('--max-page-size', type=int, default=500, help='max page size of lists, like default.page.size')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    return parser.parse_args(argv)
+
+
+def main():
+    options = parse_args()
+    server = CloudStackSimulatorServer((options.host, options.port), CloudStackSimulatorHandler)
+    server.simulator = CloudStackSimulator(options)
+    sys.stderr.write("CloudStack simulator listening on http://%s:%s/client/api\n" % (options.host, options.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()